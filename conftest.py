@@ -0,0 +1,2 @@
+# keeps the repository root on sys.path, so that the tests import utils
+# when pytest is run from here
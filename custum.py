@@ -65,6 +65,8 @@ class MyCanvas(FigureCanvas, ScrollableMixin):
         self.pan_start_y = None
         self.ispanning = False
         self.im = None
+        self.levels = []
+        self.level = None
         self.mpl_connect('button_press_event', self.on_mouse_press)
         self.mpl_connect('button_release_event', self.on_mouse_release)
         self.mpl_connect('motion_notify_event', self.on_mouse_motion)
@@ -101,23 +103,55 @@ class MyCanvas(FigureCanvas, ScrollableMixin):
             self.im.set_clim(vmin=new_vmin, vmax=new_vmax)
             self.draw()
 
-    def set_image(self, data, cmap='jet', vmax=2000):
+    def set_image(self, data, cmap='jet', vmax=2000, levels=()):
+        # levels are (binning, image) pairs of coarser copies of data, which
+        # are drawn instead of it while the view is zoomed out far enough
         try:
+            self.levels = [(1, data)] + list(levels)
+            self.level = None
             if self.im:
-                self.im.set_data(data)
                 self.im.set_cmap(cmap)
                 self.im.set_clim(vmin=0, vmax=vmax)
             else:
-                self.im = self.axes.imshow(data,
+                binning, image = self.levels[-1]
+                self.im = self.axes.imshow(image,
                                            cmap=cmap,
                                            interpolation='nearest',
                                            vmin=0,
-                                           vmax=vmax)
+                                           vmax=vmax,
+                                           extent=self.level_extent(
+                                               binning, image))
+                self.level = binning
             self.axes.set_axis_off()
             self.draw()
         except Exception as e:
             print(f"Error loading data: {e}")
 
+    def level_extent(self, binning, image):
+        # bins stay in pixel coordinates of the full image
+        ny, nx = image.shape[:2]
+        return (-0.5, nx * binning - 0.5, ny * binning - 0.5, -0.5)
+
+    def show_level(self):
+        # the coarsest level whose bins are still no larger than a screen
+        # pixel of the current view
+        if self.im is None or not self.levels:
+            return
+        x_min, x_max = self.axes.get_xlim()
+        pixels = max(self.axes.get_window_extent().width, 1)
+        binning, image = self.levels[0]
+        for b, level in self.levels:
+            if b <= abs(x_max - x_min) / pixels:
+                binning, image = b, level
+        if binning != self.level:
+            self.im.set_data(image)
+            self.im.set_extent(self.level_extent(binning, image))
+            self.level = binning
+
+    def draw(self):
+        self.show_level()
+        super().draw()
+
 
 class MyGraph(QWidget):
 
@@ -24,12 +24,12 @@ from PySide6.QtCore import (QCoreApplication, QDir, QFile, QModelIndex, Qt,
                             QTextStream, QTranslator)
 from PySide6.QtGui import (QAction, QActionGroup, QDoubleValidator, QIcon,
                            QKeySequence, QPixmap, QShortcut)
-from PySide6.QtWidgets import (QAbstractItemView, QApplication, QComboBox,
-                               QDialog, QDoubleSpinBox, QFileDialog,
+from PySide6.QtWidgets import (QAbstractItemView, QApplication, QCheckBox,
+                               QComboBox, QDialog, QDoubleSpinBox, QFileDialog,
                                QFileSystemModel, QGridLayout, QGroupBox,
                                QHBoxLayout, QLabel, QLineEdit, QListView,
                                QMainWindow, QMessageBox, QPushButton,
-                               QRadioButton, QSizePolicy, QSplitter,
+                               QRadioButton, QSizePolicy, QSpinBox, QSplitter,
                                QStatusBar, QToolBar, QVBoxLayout, QWidget)
 
 import resources_rc
@@ -62,6 +62,17 @@ class MainWindow(QMainWindow):
             "cmap": "jet",
             "vmax": 2000,
             "theme": "default",
+            "precision": "float32",
+            "normalize": False,
+            "interpolation": "linear",
+            "engine": "gather",
+            "variance": False,
+            "feather": 0,
+            "inpaint": False,
+            "mask_invalid": False,
+            "saturation": "",
+            "match": "none",
+            "registration": "masked",
         }
         self.themes_qss_map = {
             "default": ":/qss/default.qss",
@@ -73,6 +84,11 @@ class MainWindow(QMainWindow):
         self.data_first_move = None
         self.data_second_move = None
         self.data_original_path = None
+        self.fill_buffers = utils.BufferPool()
+        # the flatfield is read once per path, so that refills pass the same
+        # array and reuse the weights and spectra cached for it
+        self.flatfield_data = None
+        self.flatfield_path = None
 
         # Create central widget and layout
         self.central_widget = QWidget()
@@ -312,6 +328,86 @@ class MainWindow(QMainWindow):
         self.y2.setText("-8")
         self.gridLayout_move.addWidget(self.y2, 2, 4, 1, 1)
 
+        self.precision_label = QLabel(self.gapFillParams)
+        self.precision_label.setAlignment(Qt.AlignCenter)
+        self.gridLayout_move.addWidget(self.precision_label, 3, 0, 1, 1)
+
+        self.precision_box = QComboBox(self.gapFillParams)
+        self.precision_box.addItems(["float32", "float64"])
+        self.gridLayout_move.addWidget(self.precision_box, 3, 1, 1, 2)
+
+        self.normalize = QCheckBox(self.gapFillParams)
+        self.normalize.setChecked(False)
+        self.gridLayout_move.addWidget(self.normalize, 3, 3, 1, 2)
+
+        self.interpolation_label = QLabel(self.gapFillParams)
+        self.interpolation_label.setAlignment(Qt.AlignCenter)
+        self.gridLayout_move.addWidget(self.interpolation_label, 4, 0, 1, 1)
+
+        self.interpolation_box = QComboBox(self.gapFillParams)
+        self.interpolation_box.addItems(list(utils.INTERPOLATION_ORDER))
+        self.interpolation_box.setCurrentText("linear")
+        self.gridLayout_move.addWidget(self.interpolation_box, 4, 1, 1, 2)
+
+        self.engine_label = QLabel(self.gapFillParams)
+        self.engine_label.setAlignment(Qt.AlignCenter)
+        self.gridLayout_move.addWidget(self.engine_label, 4, 3, 1, 1)
+
+        self.engine_box = QComboBox(self.gapFillParams)
+        self.engine_box.addItems(list(utils.FILL_ENGINES))
+        self.engine_box.setCurrentText("gather")
+        self.gridLayout_move.addWidget(self.engine_box, 4, 4, 1, 1)
+
+        self.variance = QCheckBox(self.gapFillParams)
+        self.variance.setChecked(False)
+        self.gridLayout_move.addWidget(self.variance, 5, 0, 1, 3)
+
+        self.feather_label = QLabel(self.gapFillParams)
+        self.feather_label.setAlignment(Qt.AlignCenter)
+        self.gridLayout_move.addWidget(self.feather_label, 5, 3, 1, 1)
+
+        self.feather = QSpinBox(self.gapFillParams)
+        self.feather.setRange(0, 50)
+        self.gridLayout_move.addWidget(self.feather, 5, 4, 1, 1)
+
+        self.inpaint = QCheckBox(self.gapFillParams)
+        self.inpaint.setChecked(False)
+        self.gridLayout_move.addWidget(self.inpaint, 6, 0, 1, 3)
+
+        self.mask_invalid = QCheckBox(self.gapFillParams)
+        self.mask_invalid.setChecked(False)
+        self.gridLayout_move.addWidget(self.mask_invalid, 6, 3, 1, 2)
+
+        self.match_label = QLabel(self.gapFillParams)
+        self.match_label.setAlignment(Qt.AlignCenter)
+        self.gridLayout_move.addWidget(self.match_label, 7, 0, 1, 1)
+
+        self.match_box = QComboBox(self.gapFillParams)
+        self.match_box.addItems(["none"] + list(utils.INTENSITY_MATCH))
+        self.match_box.setCurrentText("none")
+        self.gridLayout_move.addWidget(self.match_box, 7, 1, 1, 2)
+
+        self.registration_label = QLabel(self.gapFillParams)
+        self.registration_label.setAlignment(Qt.AlignCenter)
+        self.gridLayout_move.addWidget(self.registration_label, 7, 3, 1, 1)
+
+        self.registration_box = QComboBox(self.gapFillParams)
+        self.registration_box.addItems(list(utils.REGISTER_METHODS))
+        self.registration_box.setCurrentText("masked")
+        self.gridLayout_move.addWidget(self.registration_box, 7, 4, 1, 1)
+
+        self.saturation_label = QLabel(self.gapFillParams)
+        self.saturation_label.setAlignment(Qt.AlignCenter)
+        self.gridLayout_move.addWidget(self.saturation_label, 8, 0, 1, 1)
+
+        self.saturation = QLineEdit(self.gapFillParams)
+        self.saturation.setValidator(
+            QDoubleValidator(0,
+                             1e12,
+                             0,
+                             notation=QDoubleValidator.StandardNotation))
+        self.gridLayout_move.addWidget(self.saturation, 8, 1, 1, 2)
+
         self.file_group = QGroupBox()
         self.file_gridLayout = QGridLayout(self.file_group)
         up_icon = QIcon(QPixmap(":/icon/uparrow.png"))
@@ -399,6 +495,7 @@ class MainWindow(QMainWindow):
         self.btn_mask = QPushButton()
         self.btn_compare = QPushButton()
         self.btn_clear = QPushButton()
+        self.btn_register = QPushButton()
         self.btn_gapfill = QPushButton()
 
         self.btn_import_params.setMinimumHeight(25)
@@ -406,6 +503,7 @@ class MainWindow(QMainWindow):
         self.btn_mask.setMinimumHeight(25)
         self.btn_compare.setMinimumHeight(25)
         self.btn_clear.setMinimumHeight(25)
+        self.btn_register.setMinimumHeight(25)
         self.btn_gapfill.setMinimumHeight(25)
 
         self.button_layout.addWidget(self.btn_import_params)
@@ -413,6 +511,7 @@ class MainWindow(QMainWindow):
         self.button_layout.addWidget(self.btn_mask)
         self.button_layout.addWidget(self.btn_compare)
         self.button_layout.addWidget(self.btn_clear)
+        self.button_layout.addWidget(self.btn_register)
         self.button_layout.addWidget(self.btn_gapfill)
 
         preview_layout.addLayout(self.button_layout, stretch=1)
@@ -422,6 +521,7 @@ class MainWindow(QMainWindow):
         self.btn_mask.clicked.connect(self.show_mask)
         self.btn_compare.clicked.connect(self.compare_images)
         self.btn_clear.clicked.connect(self.clear_all)
+        self.btn_register.clicked.connect(self.register_shifts)
         self.btn_gapfill.clicked.connect(self.gapfill)
 
         # Status bar
@@ -599,6 +699,13 @@ class MainWindow(QMainWindow):
             QCoreApplication.translate("MainWindow", "Clear"))
         self.btn_clear.setToolTip(
             QCoreApplication.translate("MainWindow", "Clear all images"))
+        self.btn_register.setText(
+            QCoreApplication.translate("MainWindow", "Register"))
+        self.btn_register.setToolTip(
+            QCoreApplication.translate(
+                "MainWindow",
+                "Measure the shifts of the moved images against the "
+                "original"))
         self.btn_gapfill.setText(
             QCoreApplication.translate("MainWindow", "Gap Fill"))
         self.use_pixel.setText(
@@ -623,6 +730,72 @@ class MainWindow(QMainWindow):
                 "positive values for the center moving right and downward"))
         self.detector_label.setText(
             QCoreApplication.translate("MainWindow", "Detector"))
+        self.precision_label.setText(
+            QCoreApplication.translate("MainWindow", "Precision"))
+        self.precision_label.setToolTip(
+            QCoreApplication.translate("MainWindow",
+                                       "Floating point type of the fill"))
+        self.normalize.setText(
+            QCoreApplication.translate("MainWindow", "Normalize"))
+        self.normalize.setToolTip(
+            QCoreApplication.translate(
+                "MainWindow",
+                "Interpolate without the gap pixels of the moved images"))
+        self.interpolation_label.setText(
+            QCoreApplication.translate("MainWindow", "Interpolation"))
+        self.engine_label.setText(
+            QCoreApplication.translate("MainWindow", "Engine"))
+        self.engine_label.setToolTip(
+            QCoreApplication.translate(
+                "MainWindow",
+                "Fourier shifts the whole moved images by a phase ramp"))
+        self.variance.setText(
+            QCoreApplication.translate("MainWindow", "Save variance"))
+        self.variance.setToolTip(
+            QCoreApplication.translate(
+                "MainWindow",
+                "Save the Poisson variance of the filled image "
+                "(nearest or linear interpolation)"))
+        self.feather_label.setText(
+            QCoreApplication.translate("MainWindow", "Feather"))
+        self.feather_label.setToolTip(
+            QCoreApplication.translate(
+                "MainWindow",
+                "Blend the moved images into this many pixels "
+                "around the gaps"))
+        self.inpaint.setText(
+            QCoreApplication.translate("MainWindow", "Inpaint"))
+        self.inpaint.setToolTip(
+            QCoreApplication.translate(
+                "MainWindow",
+                "Copy the nearest valid pixel into gap pixels "
+                "the moved images do not cover"))
+        self.mask_invalid.setText(
+            QCoreApplication.translate("MainWindow", "Mask invalid"))
+        self.mask_invalid.setToolTip(
+            QCoreApplication.translate(
+                "MainWindow",
+                "Fill negative, NaN and saturated pixels like gap pixels"))
+        self.saturation_label.setText(
+            QCoreApplication.translate("MainWindow", "Saturation"))
+        self.saturation_label.setToolTip(
+            QCoreApplication.translate(
+                "MainWindow",
+                "Counts at or above which a pixel is saturated; empty for "
+                "the largest value of the integer type"))
+        self.match_label.setText(
+            QCoreApplication.translate("MainWindow", "Match"))
+        self.match_label.setToolTip(
+            QCoreApplication.translate(
+                "MainWindow",
+                "Fit the intensity of the moved images to the original "
+                "data where they overlap"))
+        self.registration_label.setText(
+            QCoreApplication.translate("MainWindow", "Registration"))
+        self.registration_label.setToolTip(
+            QCoreApplication.translate(
+                "MainWindow",
+                "Masked registration leaves the gaps and invalid pixels out"))
         self.original.label.setText(
             QCoreApplication.translate("MainWindow", "Original Data"))
         self.moveFirst.label.setText(
@@ -775,6 +948,21 @@ class MainWindow(QMainWindow):
                 self.y1.setText(str(self.params["y1"]))
                 self.x2.setText(str(self.params["x2"]))
                 self.y2.setText(str(self.params["y2"]))
+                self.precision_box.setCurrentText(self.params["precision"])
+                self.normalize.setChecked(self.params["normalize"])
+                self.interpolation_box.setCurrentText(
+                    self.params["interpolation"])
+                self.engine_box.setCurrentText(self.params["engine"])
+                self.variance.setChecked(self.params["variance"])
+                self.feather.setValue(self.params["feather"])
+                self.inpaint.setChecked(self.params["inpaint"])
+                self.mask_invalid.setChecked(self.params["mask_invalid"])
+                self.saturation.setText(
+                    str(self.params.get("saturation", "")))
+                self.match_box.setCurrentText(
+                    self.params.get("match", "none"))
+                self.registration_box.setCurrentText(
+                    self.params.get("registration", "masked"))
             except (json.JSONDecodeError, IOError, OSError) as e:
                 self.status_bar.showMessage(f"Error: {str(e)}")
 
@@ -862,6 +1050,8 @@ class MainWindow(QMainWindow):
         if ffFile:
             try:
                 fabio.open(ffFile)
+                # choosing a file again reloads it
+                self.flatfield_path = None
                 self.flatfield_line.clear()
                 self.flatfield_line.setText(ffFile)
                 self.flatfield_line.setCursorPosition(0)
@@ -1051,7 +1241,9 @@ class MainWindow(QMainWindow):
                     self.data_first_move = None
                     self.data_second_move = None
             elif len(selected_paths) > 1 and mode == "all":
-                all_data = [utils.load_data(path) for path in selected_paths]
+                all_data = [
+                    utils.load_data(path) for path in selected_paths[:3]
+                ]
                 self.data_original = all_data[0]
                 self.data_original_path = Path(selected_paths[0])
                 if len(all_data) == 2:
@@ -1061,6 +1253,11 @@ class MainWindow(QMainWindow):
                     self.data_first_move = all_data[1]
                     self.data_second_move = all_data[2]
             self.show_all_data()
+            if len(selected_paths) > 3 and mode == "all":
+                self.status_bar.showMessage(
+                    QCoreApplication.translate(
+                        "MainWindow",
+                        "Only the first three selected files are used"))
         except Exception as e:
             self.status_bar.showMessage(str(e))
             self.data_original = None
@@ -1075,16 +1272,25 @@ class MainWindow(QMainWindow):
         self.show_data(self.data_second_move, self.moveSecond)
         self.show_data(None, self.gapfilled)
 
-    def show_data(self, data, graph: MyGraph):
+    def show_data(self, data, graph: MyGraph, cache=True):
         try:
             if data is not None:
-                max_value = np.percentile(data, 99.999)
+                max_value = int(np.percentile(data, 99.999))
                 graph.slider.setMaximum(max_value)
                 slider_value = min(self.intbox.value(), max_value)
                 graph.slider.setValue(slider_value)
-                graph.canvas.set_image(data,
-                                       cmap=self.colormap_box.currentText(),
-                                       vmax=slider_value)
+                # the pyramid that registration uses also serves the
+                # preview; a mask of another detector is left out
+                mask = self.mask_data
+                if mask is not None and np.shape(mask) != data.shape:
+                    mask = None
+                pyramid = utils.frame_pyramid(data, mask, cache)
+                graph.canvas.set_image(
+                    data,
+                    cmap=self.colormap_box.currentText(),
+                    vmax=slider_value,
+                    levels=[(level.binning, level.values)
+                            for level in pyramid[1:]])
             else:
                 graph.canvas.im = None
                 graph.canvas.axes.clear()
@@ -1100,6 +1306,7 @@ class MainWindow(QMainWindow):
         self.data_original_path = None
         self.data_first_move = None
         self.data_second_move = None
+        self.fill_buffers.clear()
         self.show_data(None, self.original)
         self.show_data(None, self.moveFirst)
         self.show_data(None, self.moveSecond)
@@ -1126,6 +1333,45 @@ class MainWindow(QMainWindow):
         except Exception as e:
             self.status_bar.showMessage(str(e))
 
+    def register_shifts(self):
+        try:
+            data0 = self.data_original
+            if data0 is None or self.data_first_move is None:
+                self.status_bar.showMessage(
+                    QCoreApplication.translate("MainWindow", "Missing data"))
+                return
+            moves = [(self.data_first_move, self.x1, self.y1),
+                     (self.data_second_move, self.x2, self.y2)]
+            for moved, x_line, y_line in moves:
+                if moved is None:
+                    continue
+                x, y = utils.register_shift(
+                    data0,
+                    moved,
+                    self.mask_data,
+                    method=self.registration_box.currentText(),
+                    workers=os.cpu_count() or 1)
+                if self.use_minimeter.isChecked():
+                    pixelsize = float(self.pixel.text())
+                    x_line.setText(f"{(x * pixelsize):.3f}")
+                    y_line.setText(f"{(y * pixelsize):.3f}")
+                else:
+                    x_line.setText(f"{x:.2f}")
+                    y_line.setText(f"{y:.2f}")
+            self.status_bar.showMessage(
+                QCoreApplication.translate("MainWindow", "Shifts registered"))
+        except Exception as e:
+            self.status_bar.showMessage(str(e))
+
+    def load_flatfield(self):
+        path = self.flatfield_line.text()
+        if not path:
+            return None
+        if path != self.flatfield_path:
+            self.flatfield_data = fabio.open(path).data
+            self.flatfield_path = path
+        return self.flatfield_data
+
     def gapfill(self):
         try:
             data0 = self.data_original
@@ -1138,10 +1384,7 @@ class MainWindow(QMainWindow):
                 self.status_bar.showMessage(
                     QCoreApplication.translate("MainWindow", "Missing data"))
                 return
-            if self.flatfield_line.text():
-                ff = fabio.open(self.flatfield_line.text()).data
-            else:
-                ff = np.ones_like(data0)
+            ff = self.load_flatfield()
             x1, y1, x2, y2 = map(float, (self.x1.text(), self.y1.text(),
                                          self.x2.text(), self.y2.text()))
             if self.use_minimeter.isChecked():
@@ -1150,12 +1393,49 @@ class MainWindow(QMainWindow):
                 y1 /= pixelsize
                 x2 /= pixelsize
                 y2 /= pixelsize
-            filled = utils.fill_gap(ff, mask, data0, data1, data2, x1, y1, x2,
-                                    y2)
-            self.show_data(filled, self.gapfilled)
+            dtype = np.dtype(self.precision_box.currentText())
+            # without a set value, integer frames saturate at the largest
+            # value of their type (the marker of Eiger detectors)
+            saturation = None
+            if self.saturation.text():
+                saturation = float(self.saturation.text())
+            elif np.issubdtype(data0.dtype, np.integer):
+                saturation = np.iinfo(data0.dtype).max
+            filled, *variance, provenance = utils.fill_gap(
+                ff,
+                mask,
+                data0,
+                data1,
+                data2,
+                x1,
+                y1,
+                x2,
+                y2,
+                out=self.fill_buffers.get(data0.shape, dtype),
+                dtype=dtype,
+                workers=os.cpu_count() or 1,
+                normalize=self.normalize.isChecked(),
+                order=utils.INTERPOLATION_ORDER[
+                    self.interpolation_box.currentText()],
+                engine=self.engine_box.currentText(),
+                variance=self.variance.isChecked(),
+                provenance=True,
+                feather=self.feather.value(),
+                inpaint=self.inpaint.isChecked(),
+                mask_invalid=self.mask_invalid.isChecked(),
+                saturation=saturation,
+                match=(None if self.match_box.currentText() == "none" else
+                       self.match_box.currentText()))
+            # the filled image lives in a pooled buffer
+            self.show_data(filled, self.gapfilled, cache=False)
             name = 0
             Image.fromarray(filled).save(path.parent /
                                          f"filled_{path.stem}.tif")
+            Image.fromarray(provenance).save(path.parent /
+                                             f"provenance_{path.stem}.tif")
+            if variance:
+                Image.fromarray(variance[0]).save(path.parent /
+                                                  f"variance_{path.stem}.tif")
         except Exception as e:
             self.status_bar.showMessage(str(e))
 
@@ -1189,6 +1469,21 @@ class MainWindow(QMainWindow):
                 self.y1.setText(str(self.params["y1"]))
                 self.x2.setText(str(self.params["x2"]))
                 self.y2.setText(str(self.params["y2"]))
+                self.precision_box.setCurrentText(self.params["precision"])
+                self.normalize.setChecked(self.params["normalize"])
+                self.interpolation_box.setCurrentText(
+                    self.params["interpolation"])
+                self.engine_box.setCurrentText(self.params["engine"])
+                self.variance.setChecked(self.params["variance"])
+                self.feather.setValue(self.params["feather"])
+                self.inpaint.setChecked(self.params["inpaint"])
+                self.mask_invalid.setChecked(self.params["mask_invalid"])
+                self.saturation.setText(
+                    str(self.params.get("saturation", "")))
+                self.match_box.setCurrentText(
+                    self.params.get("match", "none"))
+                self.registration_box.setCurrentText(
+                    self.params.get("registration", "masked"))
         except Exception as e:
             self.status_bar.showMessage(str(e))
 
@@ -1204,6 +1499,17 @@ class MainWindow(QMainWindow):
             self.params["y1"] = float(self.y1.text())
             self.params["x2"] = float(self.x2.text())
             self.params["y2"] = float(self.y2.text())
+            self.params["precision"] = self.precision_box.currentText()
+            self.params["normalize"] = self.normalize.isChecked()
+            self.params["interpolation"] = self.interpolation_box.currentText()
+            self.params["engine"] = self.engine_box.currentText()
+            self.params["variance"] = self.variance.isChecked()
+            self.params["feather"] = self.feather.value()
+            self.params["inpaint"] = self.inpaint.isChecked()
+            self.params["mask_invalid"] = self.mask_invalid.isChecked()
+            self.params["saturation"] = self.saturation.text()
+            self.params["match"] = self.match_box.currentText()
+            self.params["registration"] = self.registration_box.currentText()
             savedFile, ok = QFileDialog.getSaveFileName(
                 self.central_widget,
                 QCoreApplication.translate("MainWindow", "Save setting file"),
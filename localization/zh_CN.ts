@@ -500,6 +500,131 @@
         <source>Save setting file</source>
         <translation>保存设置文件</translation>
     </message>
+    <message>
+        <location filename="../gap.py" line="703"/>
+        <source>Register</source>
+        <translation>配准</translation>
+    </message>
+    <message>
+        <location filename="../gap.py" line="705"/>
+        <source>Measure the shifts of the moved images against the original</source>
+        <translation>测量位移图相对于原图的位移</translation>
+    </message>
+    <message>
+        <location filename="../gap.py" line="734"/>
+        <source>Precision</source>
+        <translation>精度</translation>
+    </message>
+    <message>
+        <location filename="../gap.py" line="736"/>
+        <source>Floating point type of the fill</source>
+        <translation>填充使用的浮点类型</translation>
+    </message>
+    <message>
+        <location filename="../gap.py" line="739"/>
+        <source>Normalize</source>
+        <translation>归一化</translation>
+    </message>
+    <message>
+        <location filename="../gap.py" line="741"/>
+        <source>Interpolate without the gap pixels of the moved images</source>
+        <translation>插值时不使用位移图的间隙像素</translation>
+    </message>
+    <message>
+        <location filename="../gap.py" line="745"/>
+        <source>Interpolation</source>
+        <translation>插值</translation>
+    </message>
+    <message>
+        <location filename="../gap.py" line="747"/>
+        <source>Engine</source>
+        <translation>引擎</translation>
+    </message>
+    <message>
+        <location filename="../gap.py" line="749"/>
+        <source>Fourier shifts the whole moved images by a phase ramp</source>
+        <translation>Fourier 以相位斜坡平移整幅位移图</translation>
+    </message>
+    <message>
+        <location filename="../gap.py" line="753"/>
+        <source>Save variance</source>
+        <translation>保存方差</translation>
+    </message>
+    <message>
+        <location filename="../gap.py" line="755"/>
+        <source>Save the Poisson variance of the filled image (nearest or linear interpolation)</source>
+        <translation>保存填充图像的泊松方差 (最近邻或线性插值)</translation>
+    </message>
+    <message>
+        <location filename="../gap.py" line="760"/>
+        <source>Feather</source>
+        <translation>羽化</translation>
+    </message>
+    <message>
+        <location filename="../gap.py" line="762"/>
+        <source>Blend the moved images into this many pixels around the gaps</source>
+        <translation>在间隙周围这么多像素内融合位移图</translation>
+    </message>
+    <message>
+        <location filename="../gap.py" line="767"/>
+        <source>Inpaint</source>
+        <translation>修补</translation>
+    </message>
+    <message>
+        <location filename="../gap.py" line="769"/>
+        <source>Copy the nearest valid pixel into gap pixels the moved images do not cover</source>
+        <translation>将最近的有效像素复制到位移图未覆盖的间隙像素</translation>
+    </message>
+    <message>
+        <location filename="../gap.py" line="774"/>
+        <source>Mask invalid</source>
+        <translation>屏蔽无效像素</translation>
+    </message>
+    <message>
+        <location filename="../gap.py" line="776"/>
+        <source>Fill negative, NaN and saturated pixels like gap pixels</source>
+        <translation>像间隙像素一样填充负值、NaN 和饱和像素</translation>
+    </message>
+    <message>
+        <location filename="../gap.py" line="780"/>
+        <source>Saturation</source>
+        <translation>饱和值</translation>
+    </message>
+    <message>
+        <location filename="../gap.py" line="782"/>
+        <source>Counts at or above which a pixel is saturated; empty for the largest value of the integer type</source>
+        <translation>达到或超过此计数的像素视为饱和; 留空则使用整数类型的最大值</translation>
+    </message>
+    <message>
+        <location filename="../gap.py" line="787"/>
+        <source>Match</source>
+        <translation>强度匹配</translation>
+    </message>
+    <message>
+        <location filename="../gap.py" line="789"/>
+        <source>Fit the intensity of the moved images to the original data where they overlap</source>
+        <translation>在重叠区域将位移图的强度拟合到原图</translation>
+    </message>
+    <message>
+        <location filename="../gap.py" line="794"/>
+        <source>Registration</source>
+        <translation>配准方法</translation>
+    </message>
+    <message>
+        <location filename="../gap.py" line="796"/>
+        <source>Masked registration leaves the gaps and invalid pixels out</source>
+        <translation>蒙版配准不使用间隙和无效像素</translation>
+    </message>
+    <message>
+        <location filename="../gap.py" line="1258"/>
+        <source>Only the first three selected files are used</source>
+        <translation>仅使用所选的前三个文件</translation>
+    </message>
+    <message>
+        <location filename="../gap.py" line="1362"/>
+        <source>Shifts registered</source>
+        <translation>位移已配准</translation>
+    </message>
 </context>
 <context>
     <name>ShowMaskDialog</name>
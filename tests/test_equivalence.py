@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+import utils
+
+SHIFTS = [(3.4, -2.7), (-5.2, 8.6)]
+
+
+@pytest.fixture(scope="module")
+def scene():
+    # Poisson frames off the detector, gaps at -1, and a flatfield
+    mask = utils.generate_detector_mask("Pilatus1M")
+    rng = np.random.default_rng(0)
+    frames = []
+    for _ in range(3):
+        frame = rng.poisson(1000, mask.shape).astype(np.float64)
+        frame[mask > 0] = -1
+        frames.append(frame)
+    return mask, frames, rng.uniform(0.9, 1.1, mask.shape)
+
+
+def test_whole_pixel_matches_bilinear(scene):
+    # a whole-pixel shift copies what the bilinear gather of the same
+    # shift, given as an affine, reads with weights of 0 and 1
+    mask, frames, flatfield = scene
+    shifts = [(3, -4), (-5, 9)]
+    affine = [[[1, 0, x], [0, 1, y]] for x, y in shifts]
+    whole, bilinear = (utils.get_fill_plan(mask, moves).fill(
+        flatfield, *frames, dtype=np.float64) for moves in (shifts, affine))
+    assert np.array_equal(whole, bilinear)
+
+
+def test_one_frame_ignores_second_shift(scene):
+    mask, frames, flatfield = scene
+    filled = utils.fill_gap(flatfield, mask, *frames[:2], None, 3.4, -2.7,
+                            None, None)
+    plan = utils.get_fill_plan(mask, SHIFTS[:1])
+    assert np.array_equal(filled, plan.fill(flatfield, *frames[:2]))
+
+
+@pytest.mark.parametrize("options", [{"order": 3}, {"engine": "fourier"}])
+def test_mask_invalid_without_invalid_pixels(scene, options):
+    # a whole-pixel move before a cubic or Fourier one, on valid frames
+    mask, frames, flatfield = scene
+    frames = [np.maximum(frame, 0) for frame in frames]
+    plan = utils.get_fill_plan(mask, [(3, -4), (3.4, -2.7)], **options)
+    np.testing.assert_allclose(
+        plan.fill(flatfield, *frames, dtype=np.float64, mask_invalid=True),
+        plan.fill(flatfield, *frames, dtype=np.float64))
+
+
+@pytest.mark.parametrize("workers", [2, 5, 64])
+@pytest.mark.parametrize("options", [{}, {"order": 3}, {"feather": 3}])
+def test_threads_match_serial(scene, workers, options):
+    mask, frames, flatfield = scene
+    plan = utils.get_fill_plan(mask, SHIFTS, **options)
+    assert np.array_equal(plan.fill(flatfield, *frames),
+                          plan.fill(flatfield, *frames, workers=workers))
+
+
+@pytest.mark.parametrize(
+    "options", [{}, {"order": 0}, {"feather": 3}, {"normalize": True}])
+def test_operator_matches_fill(scene, options):
+    mask, frames, flatfield = scene
+    plan = utils.get_fill_plan(mask, SHIFTS, **options)
+    operator = plan.as_operator(flatfield)
+    filled = operator @ np.concatenate([frame.ravel() for frame in frames])
+    np.testing.assert_allclose(
+        filled.reshape(mask.shape),
+        plan.fill(flatfield, *frames, dtype=np.float64))
+
+
+def test_variance_matches_squared_operator(scene):
+    mask, frames, flatfield = scene
+    plan = utils.get_fill_plan(mask, SHIFTS)
+    operator = plan.as_operator(flatfield)
+    counts = np.concatenate([np.maximum(frame, 0).ravel()
+                             for frame in frames])
+    _, var = plan.fill(flatfield, *frames, dtype=np.float64, variance=True)
+    np.testing.assert_allclose(var.ravel(),
+                               operator.multiply(operator) @ counts)
+
+
+@pytest.mark.parametrize("options", [{}, {"order": 3}, {"normalize": True}])
+@pytest.mark.parametrize("shifts", [SHIFTS, [(3.4, 0), (0, -2.7)]])
+def test_band_residual_matches_general(scene, monkeypatch, shifts, options):
+    # the per-axis band profiles give the moves the gather indices give
+    mask, frames, flatfield = scene
+    band = utils.GapFillPlan(mask, shifts, **options)
+    monkeypatch.setattr(utils, "_gap_bands", lambda gapmask, count: None)
+    general = utils.GapFillPlan(mask, shifts, **options)
+    for a, b in zip(band.moves, general.moves):
+        assert np.array_equal(a.targets, b.targets)
+    assert np.array_equal(band.unfilled, general.unfilled)
+    assert np.array_equal(band.fill(flatfield, *frames),
+                          general.fill(flatfield, *frames))
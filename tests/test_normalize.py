@@ -0,0 +1,24 @@
+import numpy as np
+
+import utils
+
+
+def test_normalize_keeps_seam_pixels():
+    # flat frames with gaps at 0: the gap pixels whose footprint only
+    # partly lies in the gap read the flat level when normalized
+    mask = utils.generate_detector_mask("Pilatus1M")
+    gap = mask > 0
+    frame = np.full(mask.shape, 100.0)
+    frame[gap] = 0
+    flatfield = np.ones(mask.shape)
+    filled = {
+        normalize: utils.get_fill_plan(mask, [(3.4, -2.7)],
+                                       normalize=normalize).fill(
+                                           flatfield, frame, frame,
+                                           dtype=np.float64)
+        for normalize in (False, True)
+    }
+    seam = gap & (filled[False] > 0) & (filled[False] < 99.9)
+    assert seam.any()
+    np.testing.assert_allclose(filled[True][seam], 100)
+    assert np.array_equal(filled[True][gap] == 0, filled[False][gap] == 0)
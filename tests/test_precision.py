@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+import utils
+
+
+@pytest.mark.parametrize("options", [{}, {"order": 3}, {"engine": "fourier"}])
+def test_float32_matches_float64(options):
+    # int32 frames off the detector, gaps at -1, filled from two moved
+    # frames in float32 and float64
+    mask = utils.generate_detector_mask("Pilatus1M")
+    rng = np.random.default_rng(0)
+    frames = []
+    for _ in range(3):
+        frame = rng.poisson(1000, mask.shape).astype(np.int32)
+        frame[mask > 0] = -1
+        frames.append(frame)
+    flatfield = rng.uniform(0.9, 1.1, mask.shape)
+    filled = {
+        dtype: utils.fill_gap(flatfield, mask, *frames, 3.4, -2.7, -5.2,
+                              8.6, dtype=dtype, **options)
+        for dtype in (np.float32, np.float64)
+    }
+    assert filled[np.float32].dtype == np.float32
+    assert filled[np.float64].dtype == np.float64
+    reference = filled[np.float64]
+    difference = np.abs(filled[np.float32] - reference)
+    difference /= np.maximum(np.abs(reference), 1)
+    assert difference.max() < 1e-5
@@ -1,6 +1,11 @@
+import hashlib
+import weakref
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
 import fabio
 import numpy as np
-from scipy.ndimage import map_coordinates
+from scipy import fft, ndimage, sparse
 
 DETECTOR_GAP = {
     "Eiger1M": [1065, 1030, [514, 550], []],
@@ -63,25 +68,1807 @@ def load_data(file_path):
     return fabio.open(file_path).data
 
 
-def fill_gap(flatfield, mask, data0, data1, data2, x1, y1, x2, y2):
-    data = data0 * flatfield
-    gapmask = mask > 0
-    data[gapmask] = 0
-    first_fill = data1 * flatfield
-    first_fill[gapmask] = 0
-    yy, xx = np.where(gapmask)
-    py = yy + y1
-    px = xx + x1
-    data[gapmask] = map_coordinates(first_fill, np.asarray([py, px]), order=1)
+INTERPOLATION_ORDER = {"nearest": 0, "linear": 1, "cubic": 3}
+
+# shifts closer than this to a whole pixel are treated as integer moves
+SHIFT_TOLERANCE = 1e-6
+
+FILL_ENGINES = ("gather", "fourier")
+
+# provenance of gap pixels that no moved frame covers
+PROVENANCE_UNFILLED = 255
+
+# provenance of gap pixels copied from their nearest valid pixel
+PROVENANCE_INPAINTED = 254
+
+# intensity matching of the moved frames, and its number of samples
+INTENSITY_MATCH = ("scale", "offset")
+MATCH_SAMPLES = 65536
+
+# rows of the original frame corrected at a time
+CORRECTION_ROWS = 64
+
+# largest side of the coarse pyramid level that shifts are first
+# registered on, side and number of the windows they are refined on at the
+# finer levels, and width in bins of the correlation peak
+REGISTER_SIZE = 256
+REGISTER_WINDOW = 256
+REGISTER_WINDOWS = 4
+REGISTER_SIGMA = 1.0
+
+# smallest fraction of valid bins of a refinement window, and smallest
+# correlation peak a refinement is kept at
+REGISTER_VALID = 0.5
+REGISTER_PEAK = 0.2
+
+# registration methods, and the smallest overlap (relative to the largest)
+# a masked correlation is trusted at
+REGISTER_METHODS = ("phase", "masked")
+REGISTER_OVERLAP = 0.3
+
+# side, in pixels, that the coarsest pyramid level fits in
+PYRAMID_SIZE = 128
+
+# mirrored margin around the frame for Fourier shifts, in pixels
+FOURIER_MARGIN = 32
+
+# radius, in pixels, that inpainted invalid pixels look for a valid one in
+INPAINT_RADIUS = 8
+
+
+_Move = namedtuple("_Move", "targets index weights coords shift")
+
+
+class GapFillPlan:
+    """Precomputed geometry for filling the gaps of one detector.
+
+    The plan is built once from the gap mask and the shifts of the moved
+    frames, each an (x, y) shift in pixels or a 2x3 affine matrix, so that
+    filling a frame only gathers the source pixels its gaps need. A gap
+    pixel is filled from the first moved frame whose source lies on the
+    detector clear of the gap, or else keeps the partial value of the last
+    one that reaches it; those no move reaches are kept in ``unfilled``.
+    """
+
+    def __init__(self,
+                 mask,
+                 shifts,
+                 shape=None,
+                 normalize=False,
+                 order=1,
+                 engine="gather",
+                 feather=0,
+                 inpaint=False,
+                 match=None):
+        gapmask = np.asarray(mask) > 0
+        if shape is not None and gapmask.shape != tuple(shape):
+            raise ValueError(f"Mask shape {gapmask.shape} does not match "
+                             f"detector shape {tuple(shape)}")
+        if order not in (0, 1, 3):
+            raise ValueError(f"Unsupported interpolation order: {order}")
+        if engine not in FILL_ENGINES:
+            raise ValueError(f"Unsupported fill engine: {engine}")
+        if match not in (None, ) + INTENSITY_MATCH:
+            raise ValueError(f"Unsupported intensity matching: {match}")
+        self.shape = gapmask.shape
+        # the gap pixel (x, y) is taken from the moved frame at
+        # (a x + b y + c, d x + e y + f) of the affine [[a, b, c], [d, e, f]],
+        # so a shift (x, y) is [[1, 0, x], [0, 1, y]]
+        self.shifts = tuple(_as_transform(shift) for shift in shifts)
+        self.normalize = normalize
+        self.order = order
+        self.engine = engine
+        self.feather = int(feather)
+        self.inpaint = inpaint
+        self.match = match
+        self.mask_key = _mask_key(gapmask)
+        self.gap_index = np.flatnonzero(gapmask)
+        gap_flat = gapmask.ravel()
+        # a source touches the gap when a pixel with a non-zero weight lies
+        # in it; for masks of full rows and columns this is decided per axis
+        # on the band profiles, for others at the gather indices
+        bands = _gap_bands(gapmask, self.gap_index.size)
+        self.moves = []
+        targets = self.gap_index
+        if self.feather > 0:
+            # the margin pixels are moved along with the gap pixels and
+            # blended with the original, which keeps d / (feather + 1) at a
+            # distance d from the gap, to hide seams between exposures
+            self._margin, self._margin_blend = _feather_margin(
+                gapmask, self.feather, bands)
+            targets = _sorted_union(targets, self._margin)
+        else:
+            self._margin = None
+        self.target_index = targets
+        for shift in self.shifts:
+            affine = np.ndim(shift) == 2
+            if affine:
+                if engine == "fourier":
+                    raise ValueError("The Fourier engine only supports "
+                                     "translations")
+                # per-axis shortcuts (whole pixels, bands) need a translation
+                coords, inside = _affine_coords(targets, self.shape, shift)
+                geometry = None
+                whole = order == 0
+            else:
+                x, y = shift
+                if order == 0:
+                    ix, iy = np.floor(x + 0.5), np.floor(y + 0.5)
+                else:
+                    ix, iy = round(x), round(y)
+                geometry = bands
+                whole = (order == 0 or
+                         max(abs(x - ix), abs(y - iy)) <= SHIFT_TOLERANCE)
+            if whole:
+                # whole-pixel move: plain offset copy, no interpolation
+                if affine:
+                    index, inside = _nearest_gather(coords, self.shape)
+                else:
+                    x, y = int(ix), int(iy)
+                    index, inside = _offset_gather(targets, self.shape, x, y)
+                if geometry is None:
+                    residual = ~inside | gap_flat[index]
+                else:
+                    residual = _band_residual(bands, targets, x, y)
+                keep = ~residual
+                self.moves.append(
+                    _Move(targets[keep], index[keep], None, None, None))
+            elif order == 3 or engine == "fourier":
+                # cubic moves evaluate the spline coefficients of the moved
+                # frame at coords, Fourier moves shift its spectrum by a
+                # phase ramp; both are cached per frame, and a source
+                # touches the gap within the 4-pixel support
+                if not affine:
+                    coords, inside = _shifted_coords(targets, self.shape, x,
+                                                     y)
+                if geometry is None:
+                    # an affine source is fractional along both axes
+                    touch = (_dilate_gap(gapmask, 0.5, 0.5)
+                             if affine else _dilate_gap(gapmask, x, y))
+                    floor = np.floor(coords).astype(np.intp)
+                    np.clip(floor[0], 0, self.shape[0] - 1, out=floor[0])
+                    np.clip(floor[1], 0, self.shape[1] - 1, out=floor[1])
+                    residual = ~inside | touch[floor[0], floor[1]]
+                else:
+                    residual = _band_residual(bands, targets, x, y, reach=2)
+                # the pixels next to a gap are written as well, from the
+                # padded frame, and still handed on
+                if engine == "fourier":
+                    self.moves.append(
+                        _Move(targets[inside], None, None, None, (x, y)))
+                else:
+                    self.moves.append(
+                        _Move(targets[inside], None, None, coords[:, inside],
+                              None))
+            else:
+                if not affine:
+                    # a move along one axis only blends the 2 neighbours
+                    # along it
+                    if abs(y - iy) <= SHIFT_TOLERANCE:
+                        y = int(iy)
+                    elif abs(x - ix) <= SHIFT_TOLERANCE:
+                        x = int(ix)
+                    coords, _ = _shifted_coords(targets, self.shape, x, y)
+                index, weights = _bilinear_gather(coords, self.shape)
+                in_gap = gap_flat[index]
+                # normalized pixels are only handed on when no tap is left,
+                # the others as soon as one lies in the gap
+                if geometry is None:
+                    used = weights > 0
+                    if normalize:
+                        residual = ~np.any(used & ~in_gap, axis=0)
+                    else:
+                        residual = np.any(used & in_gap, axis=0)
+                        residual |= ~np.any(used, axis=0)
+                else:
+                    residual = _band_residual(bands, targets, x, y,
+                                              every=normalize)
+                weights[in_gap] = 0
+                # taps without weight read a valid pixel, so that invalid
+                # (NaN, inf) values in the gaps never meet a zero weight
+                index[weights == 0] = np.argmin(gap_flat)
+                if normalize:
+                    # the gap taps otherwise count as zeros, which darkens
+                    # the pixels next to a gap
+                    total = weights.sum(axis=0)
+                    np.divide(weights, total, out=weights, where=total > 0)
+                # the pixels next to a gap are written with the weight left,
+                # and still handed on; only those without any are not written
+                keep = np.any(weights > 0, axis=0)
+                self.moves.append(
+                    _Move(targets[keep], index[:, keep], weights[:, keep],
+                          None, None))
+            # pixels whose source is off the detector or touches the gap are
+            # left for the next move
+            targets = targets[residual]
+        # handed on by the last move, and not written by any
+        self._left = targets
+        unwritten = self.target_index[self._owners(len(self.moves)) < 0]
+        self.unfilled = unwritten[gap_flat[unwritten]]
+        if inpaint or any(move.index is None for move in self.moves):
+            # gaps are padded with their nearest valid pixel before the
+            # spline prefilter or the FFT to keep them from ringing at the
+            # gap edges, and inpainted from it
+            self._gap_source = _nearest_valid(gapmask, self.gap_index,
+                                              self.mask_key, bands)
+        self._bound = None
+        self._weights = None
+        self._provenance = {}
+        self._blends = {}
+        self._inpaintings = {}
+        if match is not None:
+            # the moved frames are scaled (and offset) to the original by
+            # least squares over the pixels both see
+            self._overlap = _overlap_samples(gap_flat, self.shape,
+                                             self.shifts)
+
+    def fill(self,
+             flatfield,
+             data0,
+             *moved,
+             out=None,
+             dtype=np.float32,
+             workers=1,
+             dark=None,
+             monitor=None,
+             variance=False,
+             provenance=False,
+             mask_invalid=False,
+             saturation=None):
+        """Fill one frame, or a stack of frames with leading axes.
+
+        ``data0`` and the moved frames are (ny, nx) images or (..., ny, nx)
+        stacks. Every frame is corrected as ``(frame - dark) * flatfield /
+        monitor``, with one ``monitor`` entry per frame (``data0`` first);
+        None skips a correction. The result is computed in ``dtype``, into
+        the C-contiguous ``out`` when given, and does not depend on
+        ``workers``. It is followed by the Poisson variance (gather moves
+        only) and the provenance map (see ``provenance``) when requested.
+        ``mask_invalid`` also fills the negative, NaN and ``saturation``
+        pixels of the original, and never reads those of the moved frames.
+        """
+        data0 = np.asarray(data0)
+        if data0.shape[-2:] != self.shape:
+            raise ValueError(f"Frame shape {data0.shape[-2:]} does not "
+                             f"match detector shape {self.shape}")
+        if out is None:
+            data = np.empty(data0.shape, dtype=dtype)
+        elif out.shape != data0.shape or not out.flags.c_contiguous:
+            raise ValueError(f"out must be a C-contiguous array of shape "
+                             f"{data0.shape}")
+        else:
+            data = out
+        # the moved frames used: those before the first None
+        used = next((k for k, frame in enumerate(moved) if frame is None),
+                    len(moved))
+        if monitor is None:
+            scales = [None] * (1 + len(self.moves))
+        elif len(monitor) < 1 + min(used, len(self.moves)):
+            raise ValueError("monitor needs one entry per frame")
+        else:
+            # one reciprocal per frame, shaped to scale flat pixel rows
+            scales = [
+                None if m is None else np.reciprocal(
+                    np.asarray(m, dtype=data.dtype))[..., None]
+                for m in monitor
+            ]
+        # the flatfield and dark are folded into the gather weights (and one
+        # offset per target), and the monitor applied to the gathered
+        # values, so the moved frames are never corrected in full
+        weights, offsets = self._bound_weights(flatfield, dark, data.dtype)
+        var = None
+        squares = None
+        if variance:
+            # counts of variance max(frame, 0), the dark taken as exact,
+            # propagated with the squared weights in the same pass
+            var = np.empty(data.shape, dtype=data.dtype)
+            squares = [None if w is None else np.square(w) for w in weights]
+        # invalid pixels: the saturation, the (move, targets, frames) whose
+        # source is invalid, handed on to the next move, and the (pixels,
+        # frames) invalid in the original
+        invalid = (saturation, [], []) if mask_invalid else None
+        clean = (saturation, ) if mask_invalid else None
+        sources = []
+        for k, (move, frame) in enumerate(zip(self.moves, moved)):
+            if frame is None:
+                break
+            frame = np.asarray(frame)
+            if variance and move.index is None and move.targets.size:
+                raise ValueError("Variance is only propagated through "
+                                 "gather (nearest or linear) moves")
+            if move.coords is not None:
+                sources.append(
+                    self._spline_coefficients(frame, flatfield, dark,
+                                              data.dtype, clean))
+            elif move.shift is not None:
+                sources.append(
+                    self._fourier_shifted(frame, flatfield, dark, move.shift,
+                                          data.dtype, workers, clean))
+            else:
+                sources.append(frame.reshape(frame.shape[:-2] + (-1, )))
+            if invalid is not None and move.index is None:
+                # splines and spectra are computed from a frame cleaned of
+                # its invalid pixels; the targets next to one are handed on
+                coords = move.coords
+                if coords is None:
+                    coords, _ = _shifted_coords(move.targets, self.shape,
+                                                *move.shift)
+                index, taps = _bilinear_gather(coords, self.shape)
+                frame_flat = frame.reshape(frame.shape[:-2] + (-1, ))
+                failed = _failed_taps(frame_flat[..., index], taps,
+                                      saturation)
+                _hand_on(invalid[1], k, move.targets, failed)
+        blend = None
+        if self._margin is not None:
+            blend = self._blend(len(sources)).astype(data.dtype)
+        gains = [None] * len(self.moves)
+        if self.match is not None:
+            gains = self._match_gains(data0, moved[:len(sources)], flatfield,
+                                      dark, scales, data.dtype, invalid)
+        corrections = (flatfield, dark, weights, offsets, scales, squares,
+                       blend, gains, invalid)
+        # row bands on a thread pool, each computing its pixels exactly as
+        # the serial path does
+        ny = self.shape[0]
+        workers = max(1, min(int(workers), ny))
+        if workers == 1:
+            self._fill_rows(data, var, data0, sources, corrections, 0, ny)
+        else:
+            rows = np.linspace(0, ny, workers + 1).astype(int)
+            jobs = [
+                _get_executor(workers).submit(self._fill_rows, data, var,
+                                              data0, sources, corrections,
+                                              start, stop)
+                for start, stop in zip(rows[:-1], rows[1:])
+            ]
+            for job in jobs:
+                job.result()
+        refilled = None
+        if invalid is not None:
+            # after all bands, as the handed-on pixels come from every band
+            refilled = self._refill(data, var, data0, moved[:len(sources)],
+                                    corrections)
+        if self.inpaint:
+            # after all bands, as the nearest pixel may lie in another band
+            left, source = self._inpainting(len(sources))
+            for output in (data, var):
+                if output is not None:
+                    output_flat = output.reshape(output.shape[:-2] + (-1, ))
+                    output_flat[..., left] = output_flat[..., source]
+        result = [data]
+        if variance:
+            result.append(var)
+        if provenance:
+            prov = self.provenance(len(sources))
+            if refilled is not None:
+                prov = prov.copy()
+                pixels, owner = refilled
+                unfilled = (PROVENANCE_INPAINTED
+                            if self.inpaint else PROVENANCE_UNFILLED)
+                prov.ravel()[pixels] = np.where(owner < 0, unfilled,
+                                                owner + 1)
+                prov.flags.writeable = False
+            result.append(prov)
+        return tuple(result) if len(result) > 1 else data
+
+    def _fill_rows(self, data, var, data0, sources, corrections, start,
+                   stop):
+        # fill rows [start, stop) of data, and of var when given; only these
+        # rows are written
+        dtype = data.dtype
+        (flatfield, dark, weights, offsets, scales, squares, blend, gains,
+         invalid) = corrections
+        # data0 is corrected in blocks of rows that stay in cache between
+        # the dark, flatfield and monitor steps
+        for lo in range(start, stop, CORRECTION_ROWS):
+            block = (Ellipsis, slice(lo, min(lo + CORRECTION_ROWS,
+                                             stop)), slice(None))
+            out = data[block]
+            if invalid is not None:
+                # found in the same cached block, filled after the bands
+                bad = _invalid(data0[block], invalid[0])
+                bad = bad.reshape(bad.shape[:-2] + (-1, ))
+                hit = np.flatnonzero(_any_frame(bad))
+                if hit.size:
+                    invalid[2].append(
+                        (hit + lo * self.shape[1], bad[..., hit]))
+            if dark is None:
+                np.copyto(out, data0[block])
+            else:
+                np.subtract(data0[block],
+                            _image_rows(dark, block),
+                            out=out,
+                            dtype=dtype)
+            if flatfield is not None:
+                np.multiply(out,
+                            _image_rows(flatfield, block),
+                            out=out,
+                            dtype=dtype)
+            if scales[0] is not None:
+                np.multiply(out, scales[0][..., None], out=out)
+            if var is not None:
+                out = var[block]
+                np.maximum(data0[block], 0, out=out, dtype=dtype)
+                if flatfield is not None:
+                    np.multiply(out,
+                                np.square(_image_rows(flatfield, block),
+                                          dtype=dtype),
+                                out=out)
+                if scales[0] is not None:
+                    np.multiply(out, np.square(scales[0][..., None]), out=out)
+        nx = self.shape[1]
+        bounds = (start * nx, stop * nx)
+        outputs = [data.reshape(data.shape[:-2] + (-1, ))]
+        if var is not None:
+            outputs.append(var.reshape(var.shape[:-2] + (-1, )))
+        for output in outputs:
+            output[..., _in_range(self.gap_index, bounds)] = 0
+        if blend is not None:
+            margin = _in_range(self._margin, bounds)
+            blend = blend[slice(*np.searchsorted(self._margin, bounds))]
+            originals = [output[..., margin] for output in outputs]
+        data_flat = outputs[0]
+        for k, (move, w, offset, scale, gain, source) in enumerate(
+                zip(self.moves, weights, offsets, scales[1:], gains,
+                    sources)):
+            targets, index, _, coords, shift = move
+            lo, hi = np.searchsorted(targets, bounds)
+            if coords is not None:
+                values = _spline_values(source, coords[:, lo:hi], dtype)
+            elif shift is not None:
+                # the shifted frame is computed in full before the bands
+                values = source[..., targets[lo:hi]]
+            else:
+                gathered = source[..., index[..., lo:hi]]
+                if invalid is not None:
+                    bad = _invalid(gathered, invalid[0])
+                    if bad.any():
+                        # invalid taps read 0 and their targets are handed on
+                        gathered = np.where(bad, 0, gathered)
+                        failed = _failed_taps(
+                            gathered, None if index.ndim == 1 else
+                            move.weights[:, lo:hi], invalid[0], bad)
+                        _hand_on(invalid[1], k, targets[lo:hi], failed)
+                values = gathered
+                if w is not None:
+                    values = np.multiply(values, w[..., lo:hi], dtype=dtype)
+                if index.ndim > 1:
+                    values = values.sum(axis=-2, dtype=dtype)
+                if offset is not None:
+                    values = np.subtract(values, offset[lo:hi], dtype=dtype)
+                if var is not None:
+                    # the counts of the same gather, with squared weights
+                    counts = np.maximum(gathered, 0, dtype=dtype)
+                    if squares[k] is not None:
+                        counts *= squares[k][..., lo:hi]
+                    if index.ndim > 1:
+                        counts = counts.sum(axis=-2, dtype=dtype)
+                    if scale is not None:
+                        counts *= np.square(scale)
+                    if gain is not None:
+                        counts *= np.square(gain[0])
+                    outputs[1][..., targets[lo:hi]] = counts
+            if scale is not None:
+                values = np.multiply(values, scale, dtype=dtype)
+            if gain is not None:
+                values = np.multiply(values, gain[0], dtype=dtype)
+                if self.match == "offset":
+                    values += gain[1]
+            data_flat[..., targets[lo:hi]] = values
+        if blend is not None:
+            if invalid is not None and invalid[1]:
+                # margin pixels without a valid moved value keep the original
+                failed = np.concatenate([f[1] for f in list(invalid[1])])
+                blend = np.where(np.isin(margin, failed), 0, blend)
+            # feathered margin: one multiply-add per pixel
+            moved = data_flat[..., margin]
+            moved -= originals[0]
+            moved *= blend
+            moved += originals[0]
+            data_flat[..., margin] = moved
+            if var is not None:
+                outputs[1][..., margin] = (
+                    np.square(1 - blend) * originals[1] +
+                    np.square(blend) * outputs[1][..., margin])
+
+    def _padded_frame(self, frame, flatfield, dark, dtype, clean=None):
+        # corrected copy of the frame with the gaps padded with their
+        # nearest valid pixel, which keeps global interpolators (splines,
+        # Fourier shifts) from ringing at the gap edges
+        data = np.array(frame, dtype=dtype)
+        if clean is not None:
+            # invalid pixels take the previous valid pixel of their row
+            # order, so that a NaN or a saturated pixel does not spread
+            data_flat = data.reshape(data.shape[:-2] + (-1, ))
+            bad = _invalid(data_flat, clean[0])
+            if bad.any():
+                previous = np.where(bad, 0, np.arange(bad.shape[-1]))
+                np.maximum.accumulate(previous, axis=-1, out=previous)
+                data_flat[...] = np.take_along_axis(data_flat, previous, -1)
+                data_flat[_invalid(data_flat, clean[0])] = 0
+        if dark is not None:
+            data -= dark
+        if flatfield is not None:
+            data *= flatfield
+        data_flat = data.reshape(data.shape[:-2] + (-1, ))
+        data_flat[..., self.gap_index] = data_flat[..., self._gap_source]
+        return data
+
+    def _spline_coefficients(self, frame, flatfield, dark, dtype,
+                             clean=None):
+
+        def compute():
+            coeffs = self._padded_frame(frame, flatfield, dark, dtype, clean)
+            for axis in (-2, -1):
+                ndimage.spline_filter1d(coeffs,
+                                        3,
+                                        axis=axis,
+                                        output=coeffs,
+                                        mode="mirror")
+            return coeffs
+
+        return _frame_cached("spline", frame, (flatfield, dark, clean),
+                             self.mask_key, dtype, compute)
+
+    def _fourier_shifted(self,
+                         frame,
+                         flatfield,
+                         dark,
+                         shift,
+                         dtype,
+                         workers,
+                         clean=None):
+        # the frame is mirrored into a margin so that the periodic wrap of
+        # the FFT rings away from the detector edges
+        ny, nx = self.shape
+        margin = (min(FOURIER_MARGIN, ny - 1), min(FOURIER_MARGIN, nx - 1))
+        size = (fft.next_fast_len(ny + 2 * margin[0], True),
+                fft.next_fast_len(nx + 2 * margin[1], True))
+
+        def compute():
+            data = self._padded_frame(frame, flatfield, dark, dtype, clean)
+            pad = [(0, 0)] * (data.ndim - 2)
+            pad += [(margin[0], size[0] - ny - margin[0]),
+                    (margin[1], size[1] - nx - margin[1])]
+            data = np.pad(data, pad, mode="reflect")
+            return fft.rfft2(data, workers=workers)
+
+        spectrum = _frame_cached("rfft", frame, (flatfield, dark, clean),
+                                 self.mask_key, dtype, compute)
+        # frame(p + shift) is a phase ramp in Fourier space
+        x, y = shift
+        ramp_y = np.exp(2j * np.pi * y * fft.fftfreq(size[0]))
+        ramp_x = np.exp(2j * np.pi * x * fft.rfftfreq(size[1]))
+        shifted = spectrum * ramp_y.astype(spectrum.dtype)[:, None]
+        shifted *= ramp_x.astype(spectrum.dtype)
+        shifted = fft.irfft2(shifted, s=size, workers=workers)
+        shifted = shifted[..., margin[0]:margin[0] + ny,
+                          margin[1]:margin[1] + nx]
+        shifted = shifted.reshape(shifted.shape[:-2] + (-1, ))
+        return shifted.astype(dtype, copy=False)
+
+    def provenance(self, count=None):
+        """Return the uint8 map of where every filled pixel comes from.
+
+        Pixels read 0 when taken from the original frame and k when taken
+        from the k-th moved frame. Gap pixels that none of the first
+        ``count`` moved frames (all by default) covers read
+        ``PROVENANCE_INPAINTED`` for inpainting plans and
+        ``PROVENANCE_UNFILLED`` otherwise. The map only depends on the
+        geometry; it is cached per ``count`` and returned read-only.
+        """
+        count = len(self.moves) if count is None else count
+        prov = self._provenance.get(count)
+        if prov is None:
+            owner = self._owners(count)
+            owner = owner[np.searchsorted(self.target_index, self.gap_index)]
+            prov = np.zeros(self.shape, dtype=np.uint8)
+            unfilled = (PROVENANCE_INPAINTED
+                        if self.inpaint else PROVENANCE_UNFILLED)
+            prov.ravel()[self.gap_index] = np.where(owner < 0, unfilled,
+                                                    owner + 1)
+            prov.flags.writeable = False
+            self._provenance[count] = prov
+        return prov
+
+    def _owners(self, count):
+        # index of the move that writes each target pixel last, -1 for none
+        owner = np.full(self.target_index.size, -1)
+        for k, move in enumerate(self.moves[:count]):
+            owner[np.searchsorted(self.target_index, move.targets)] = k
+        return owner
+
+    def _unwritten(self, count):
+        # the target pixels that none of the first count moves writes
+        return self.target_index[self._owners(count) < 0]
+
+    def _match_gains(self, data0, moved, flatfield, dark, scales, dtype,
+                     invalid=None):
+        # (gain, offset) of every moved frame, fitted on the overlap samples
+        gains = []
+        for (samples, index, weights), frame, scale in zip(
+                self._overlap, moved, scales[1:]):
+            reference = _sample_values(data0, samples, None, flatfield, dark)
+            values = _sample_values(frame, index, weights, flatfield, dark)
+            if scales[0] is not None:
+                reference *= scales[0]
+            if scale is not None:
+                values *= scale
+            valid = None
+            if invalid is not None:
+                # samples with an invalid pixel in either frame are left out
+                frame = np.asarray(frame)
+                data0_flat = data0.reshape(data0.shape[:-2] + (-1, ))
+                frame_flat = frame.reshape(frame.shape[:-2] + (-1, ))
+                valid = ~(_invalid(data0_flat[..., samples], invalid[0]) |
+                          _failed_taps(frame_flat[..., index], weights,
+                                       invalid[0]))
+            gain, offset = _fit_gain(reference, values,
+                                     self.match == "offset", valid)
+            gains.append((gain[..., None].astype(dtype),
+                          offset[..., None].astype(dtype)))
+        return gains
+
+    def _refill(self, data, var, data0, moved, corrections):
+        # fill the invalid pixels of the original, and the gap pixels whose
+        # source was invalid, from the first moved frame with a clean
+        # bilinear (nearest for order 0) source, or else the last one that
+        # reaches them, leaving out gap and invalid taps; returns these
+        # pixels and the move that filled each (-1 for none), or None when
+        # there are none. A pixel is only written in the frames of a stack
+        # that need it.
+        (flatfield, dark, _, _, scales, _, _, gains,
+         (saturation, failures, originals)) = corrections
+        if not failures and not originals:
+            return None
+        lead = data0.shape[:-2]
+        gap_flat = np.zeros(self.shape[0] * self.shape[1], dtype=bool)
+        gap_flat[self.gap_index] = True
+        # (first move to try, pixels, frames that need them)
+        pending = []
+        for pixels, bad in originals:
+            # invalid gap pixels are filled anyway
+            keep = ~gap_flat[pixels]
+            pending.append((0, pixels[keep], bad[..., keep]))
+        for k, targets, failed in failures:
+            # margin pixels keep the original instead; the others start at
+            # their own move, whose value without the invalid taps they keep
+            # unless a later move has a clean source
+            gap = gap_flat[targets]
+            pending.append((k, targets[gap], failed[..., gap]))
+        everything = np.concatenate([entry[1] for entry in pending])
+        owner = np.full(everything.size, -1)
+        starts = np.cumsum([0] + [entry[1].size for entry in pending])
+        outputs = [data.reshape(lead + (-1, ))]
+        if var is not None:
+            outputs.append(var.reshape(lead + (-1, )))
+        slots = np.empty(0, dtype=np.intp)
+        needs = np.empty(lead + (0, ), dtype=bool)
+        # pixels given a partial value, from a footprint with holes
+        reached = np.empty(lead + (0, ), dtype=bool)
+        for k in range(len(moved) + 1):
+            for (first, _, failed), start, stop in zip(pending, starts,
+                                                       starts[1:]):
+                if first == k or (k == len(moved) and first > k):
+                    slots = np.concatenate([slots, np.arange(start, stop)])
+                    needs = np.concatenate([needs, failed], axis=-1)
+                    reached = np.concatenate(
+                        [reached, np.zeros_like(failed)], axis=-1)
+            if k == len(moved) or not slots.size:
+                continue
+            pixels = everything[slots]
+            transform = self.shifts[k]
+            if np.ndim(transform) == 2:
+                coords, inside = _affine_coords(pixels, self.shape, transform)
+            else:
+                coords, inside = _shifted_coords(pixels, self.shape,
+                                                 *transform)
+            if self.order == 0:
+                index, inside = _nearest_gather(coords, self.shape)
+                index, weights = index[None], inside[None].astype(float)
+            else:
+                index, weights = _bilinear_gather(coords, self.shape)
+            frame = np.asarray(moved[k])
+            raw = frame.reshape(lead + (-1, ))[..., index]
+            # gap and invalid taps are holes in the footprint
+            holes = gap_flat[index] | _invalid(raw, saturation)
+            ok = inside & ~np.any((weights != 0) & holes, axis=-2)
+            weights = np.where(holes, 0, weights)
+            partial = np.any(weights != 0, axis=-2)
+            if self.normalize:
+                # the taps left are renormalized, as in the plan
+                total = weights.sum(axis=-2, keepdims=True)
+                weights = np.divide(weights, total, out=np.zeros_like(weights),
+                                    where=total > 0)
+                ok = partial
+            raw = np.where(holes, 0, raw).astype(np.float64)
+            taps = raw
+            if dark is not None:
+                taps = taps - _flat_values(dark, index)
+            if flatfield is not None:
+                weights = weights * _flat_values(flatfield, index)
+            values = [(taps * weights).sum(axis=-2)]
+            if var is not None:
+                values.append((raw * np.square(weights)).sum(axis=-2))
+            factor = 1
+            if scales[k + 1] is not None:
+                factor = factor * scales[k + 1]
+            if gains[k] is not None:
+                factor = factor * gains[k][0]
+            values[0] *= factor
+            if gains[k] is not None and self.match == "offset":
+                values[0] += gains[k][1]
+            if var is not None:
+                values[1] *= np.square(factor)
+            write = needs & partial
+            for output, value in zip(outputs, values):
+                output[..., pixels] = np.where(write, value,
+                                               output[..., pixels])
+            owner[slots[_any_frame(write)]] = k
+            reached |= write
+            needs &= ~ok
+            keep = _any_frame(needs)
+            slots, needs = slots[keep], needs[..., keep]
+            reached = reached[..., keep]
+        # the pixels no move reaches read 0, or are inpainted
+        needs &= ~reached
+        keep = _any_frame(needs)
+        slots, needs = slots[keep], needs[..., keep]
+        pixels = everything[slots]
+        for output in outputs:
+            output[..., pixels] = np.where(needs, 0, output[..., pixels])
+        if self.inpaint and pixels.size:
+            gap = gap_flat[pixels]
+            if not gap.all():
+                # invalid pixels of the original that no move covers take
+                # their nearest pixel that is neither gap nor left
+                holes = gap_flat.copy()
+                holes[pixels[~gap]] = True
+                left = pixels[~gap]
+                _copy_where(outputs, left,
+                            _nearest_pixel(holes, self.shape, left),
+                            needs[..., ~gap])
+            left = pixels[gap]
+            source = self._gap_source[np.searchsorted(self.gap_index, left)]
+            _copy_where(outputs, left, source, needs[..., gap])
+        return everything, owner
+
+    def _inpainting(self, count):
+        # the gap pixels left by count moves and their nearest valid pixels
+        inpainting = self._inpaintings.get(count)
+        if inpainting is None:
+            left = np.intersect1d(self._unwritten(count), self.gap_index,
+                                  assume_unique=True)
+            source = self._gap_source[np.searchsorted(self.gap_index, left)]
+            inpainting = self._inpaintings[count] = (left, source)
+        return inpainting
+
+    def _blend(self, count):
+        # share of the moved value in every margin pixel when count moves
+        # are used; pixels no move covers keep the original
+        blend = self._blends.get(count)
+        if blend is None:
+            blend = self._margin_blend.copy()
+            left = np.zeros(self.target_index.size, dtype=bool)
+            left[np.searchsorted(self.target_index,
+                                 self._unwritten(count))] = True
+            blend[left[np.searchsorted(self.target_index, self._margin)]] = 0
+            self._blends[count] = blend
+        return blend
+
+    def as_operator(self, flatfield=None, dtype=np.float64):
+        """Return the fill as a sparse CSR matrix.
+
+        The matrix has shape (P, P * (1 + n)) for P detector pixels and n
+        moved frames. Applied to the concatenated flattened frames
+        ``[data0, data1, ...]`` (or to a matrix with one such column per
+        frame set) it gives the flattened filled image. Its transpose maps
+        output pixels back to the input pixels they were taken from.
+        """
+        if any(move.coords is not None for move in self.moves):
+            raise ValueError("Cubic fills are not a sparse operator")
+        if any(move.shift is not None for move in self.moves):
+            raise ValueError("Fourier fills are not a sparse operator")
+        if self.match is not None:
+            # the gains are fitted to the frames, so no fixed matrix holds
+            raise ValueError("Intensity-matched fills are not a sparse "
+                             "operator")
+        size = self.shape[0] * self.shape[1]
+        # the last move that writes a target pixel decides its value
+        owner = self._owners(len(self.moves))
+        keep = np.ones(size, dtype=bool)
+        keep[self.gap_index] = False
+        rows = [np.flatnonzero(keep)]
+        cols = [rows[0]]
+        if flatfield is None:
+            values = [np.ones(rows[0].size)]
+        else:
+            values = [np.broadcast_to(flatfield, self.shape).ravel()[rows[0]]]
+        # share of the moved value, below 1 in the feathered margin
+        share = np.ones(self.target_index.size)
+        if self._margin is not None:
+            blend = self._blend(len(self.moves))
+            share[np.searchsorted(self.target_index, self._margin)] = blend
+            values[0] = values[0].copy()
+            values[0][np.searchsorted(rows[0], self._margin)] *= 1 - blend
+        weights, _ = self._bound_weights(flatfield, None, np.dtype(dtype))
+        for k, (move, w) in enumerate(zip(self.moves, weights)):
+            targets, index = move.targets, move.index
+            position = np.searchsorted(self.target_index, targets)
+            final = owner[position] == k
+            index = index[..., final]
+            w = np.ones(index.shape) if w is None else w[..., final]
+            w = w * share[position[final]]
+            rows.append(np.broadcast_to(targets[final], index.shape).ravel())
+            cols.append(index.ravel() + (k + 1) * size)
+            values.append(w.ravel())
+        operator = sparse.csr_matrix(
+            (np.concatenate(values), (np.concatenate(rows),
+                                      np.concatenate(cols))),
+            shape=(size, size * (1 + len(self.moves))),
+            dtype=dtype)
+        operator.eliminate_zeros()
+        if self.inpaint:
+            # inpainted pixels repeat the row of their nearest valid pixel
+            left, source = self._inpainting(len(self.moves))
+            pick = np.arange(size)
+            pick[left] = source
+            operator = operator[pick]
+        return operator
+
+    def _bound_weights(self, flatfield, dark, dtype):
+        # the flatfield is folded into the gather weights, and the dark into
+        # one offset per gap pixel, once and reused for as long as the same
+        # flatfield and dark arrays and dtype are passed in
+        bound = self._bound
+        if (bound is None or bound[0] is not flatfield or bound[1] is not dark
+                or bound[2] != dtype):
+            weights = []
+            offsets = []
+            if dark is not None:
+                dark_flat = np.broadcast_to(dark, self.shape).ravel()
+            for move in self.moves:
+                index, w = move.index, move.weights
+                if flatfield is not None and index is not None:
+                    ff = np.broadcast_to(flatfield, self.shape).ravel()[index]
+                    w = ff if w is None else ff * w
+                offset = None
+                if dark is not None and index is not None:
+                    offset = dark_flat[index] if w is None else (
+                        dark_flat[index] * w)
+                    if index.ndim > 1:
+                        offset = offset.sum(axis=0)
+                    offset = offset.astype(dtype)
+                if w is not None:
+                    w = w.astype(dtype)
+                weights.append(w)
+                offsets.append(offset)
+            self._bound = (flatfield, dark, dtype)
+            self._weights = (weights, offsets)
+        return self._weights
+
+
+def _image_rows(image, block):
+    # rows of a detector image, or the scalar itself
+    image = np.asarray(image)
+    return image[block] if image.ndim >= 2 else image
+
+
+def _feather_margin(gapmask, feather, bands):
+    # valid pixels within feather pixels of a gap and the share of the
+    # moved value in each, falling linearly with the distance to the gap
+    if bands is None:
+        distance = ndimage.distance_transform_edt(~gapmask).ravel()
+        margin = np.flatnonzero((distance > 0) & (distance <= feather))
+        distance = distance[margin]
+    else:
+        # the distance to full rows and columns is the smaller of the
+        # distances along each axis, so only rows and columns near a band
+        # are looked at
+        ny, nx = gapmask.shape
+        near = [_axis_distance(profile) for profile in bands]
+        rows = np.flatnonzero((near[0] > 0) & (near[0] <= feather))
+        cols = np.flatnonzero((near[1] > 0) & (near[1] <= feather))
+        margin = _sorted_union((rows[:, None] * nx + np.arange(nx)).ravel(),
+                               (np.arange(ny)[:, None] * nx + cols).ravel())
+        yy, xx = np.divmod(margin, nx)
+        distance = np.minimum(near[0][yy], near[1][xx])
+        keep = distance > 0
+        margin = margin[keep]
+        distance = distance[keep]
+    return margin, 1 - distance / (feather + 1)
+
+
+def _overlap_samples(gap_flat, shape, transforms):
+    # strided valid pixels of the original and, per move, the bilinear
+    # taps of those whose moved source is on the detector and valid
+    stride = max(1, gap_flat.size // MATCH_SAMPLES)
+    samples = np.arange(0, gap_flat.size, stride)
+    samples = samples[~gap_flat[samples]]
+    overlap = []
+    for transform in transforms:
+        if np.ndim(transform) == 2:
+            coords, inside = _affine_coords(samples, shape, transform)
+        else:
+            coords, inside = _shifted_coords(samples, shape, *transform)
+        index, weights = _bilinear_gather(coords, shape)
+        keep = inside & ~np.any((weights > 0) & gap_flat[index], axis=0)
+        overlap.append((samples[keep], index[:, keep], weights[:, keep]))
+    return overlap
+
+
+def _sample_values(frame, index, weights, flatfield, dark):
+    # corrected values of a frame at flat indices, in double precision,
+    # summed over the taps when weights are given
+    frame = np.asarray(frame)
+    values = frame.reshape(frame.shape[:-2] + (-1, ))[..., index]
+    values = values.astype(np.float64)
+    if dark is not None:
+        values -= _flat_values(dark, index)
+    if flatfield is not None:
+        values *= _flat_values(flatfield, index)
+    if weights is not None:
+        values = (values * weights).sum(axis=-2)
+    return values
+
+
+def _flat_values(image, index):
+    # pixels of a detector image at flat indices, or the scalar itself
+    image = np.asarray(image)
+    return image.ravel()[index] if image.ndim >= 2 else image
+
+
+def _fit_gain(reference, values, offset, valid=None):
+    # least-squares gain (and offset) taking values to reference, per frame
+    # of the leading axes, over the valid samples when given
+    if valid is not None:
+        reference = np.where(valid, reference, 0)
+        values = np.where(valid, values, 0)
+    if not offset:
+        norm = np.square(values).sum(axis=-1)
+        gain = np.divide((reference * values).sum(axis=-1),
+                         norm,
+                         out=np.ones_like(norm),
+                         where=norm > 0)
+        return gain, np.zeros_like(gain)
+    n = values.shape[-1] if valid is None else valid.sum(axis=-1)
+    sx, sy = values.sum(axis=-1), reference.sum(axis=-1)
+    sxx = np.square(values).sum(axis=-1)
+    sxy = (reference * values).sum(axis=-1)
+    det = n * sxx - sx * sx
+    gain = np.divide(n * sxy - sx * sy,
+                     det,
+                     out=np.ones_like(det),
+                     where=det > 0)
+    return gain, (sy - gain * sx) / np.maximum(n, 1)
+
+
+def _sorted_union(a, b):
+    # np.union1d for flat indices, without its hash-based unique
+    merged = np.sort(np.concatenate([a, b]))
+    if merged.size:
+        merged = merged[np.concatenate([[True], merged[1:] != merged[:-1]])]
+    return merged
+
+
+def _axis_distance(profile):
+    # distance of every row (or column) to the nearest gap band
+    if not profile.any():
+        return np.full(profile.size, np.inf)
+    return ndimage.distance_transform_edt(~profile)
+
+
+def _in_range(indices, bounds):
+    # slice of the sorted flat indices that fall in [bounds[0], bounds[1])
+    lo, hi = np.searchsorted(indices, bounds)
+    return indices[lo:hi]
+
+
+_EXECUTORS = {}
+
+
+def _get_executor(workers):
+    executor = _EXECUTORS.get(workers)
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=workers)
+        _EXECUTORS[workers] = executor
+    return executor
+
+
+def _offset_gather(targets, shape, ix, iy):
+    ny, nx = shape
+    yy, xx = np.divmod(targets, nx)
+    yy += iy
+    xx += ix
+    inside = (yy >= 0) & (yy < ny) & (xx >= 0) & (xx < nx)
+    index = np.where(inside, yy * nx + xx, 0)
+    return index, inside
+
+
+_FRAME_CACHE = OrderedDict()
+_FRAME_CACHE_SIZE = 4
+
+# pyramids hold their frame, so only the frames in view are kept
+_PYRAMID_CACHE = OrderedDict()
+_PYRAMID_CACHE_SIZE = 3
+
+
+def _frame_cached(kind,
+                  frame,
+                  inputs,
+                  mask_key,
+                  dtype,
+                  compute,
+                  cache=_FRAME_CACHE,
+                  size=_FRAME_CACHE_SIZE):
+    # per-frame results (spline coefficients, spectra) are cached per
+    # (frame, correction inputs, mask, dtype) so that changing the shifts
+    # does not redo them; arrays are keyed by identity and assumed not to
+    # be modified in place, scalars and None by value
+    arrays = [x for x in (frame, ) + inputs if isinstance(x, np.ndarray)]
+    key = (kind, mask_key, np.dtype(dtype)) + tuple(
+        id(x) if isinstance(x, np.ndarray) else x for x in (frame, ) + inputs)
+    entry = cache.get(key)
+    if entry is not None and all(
+            ref() is x for ref, x in zip(entry[0], arrays)):
+        cache.move_to_end(key)
+        return entry[1]
+    value = compute()
+    cache[key] = ([weakref.ref(x) for x in arrays], value)
+    while len(cache) > size:
+        cache.popitem(last=False)
+    return value
+
+
+_NEAREST_CACHE = OrderedDict()
+_NEAREST_CACHE_SIZE = 4
+
+
+def _nearest_valid(gapmask, gap_index, mask_key, bands=None):
+    # flat index of the nearest non-gap pixel of every gap pixel, cached
+    # per mask since it does not depend on the shifts
+    source = _NEAREST_CACHE.get(mask_key)
+    if source is not None:
+        _NEAREST_CACHE.move_to_end(mask_key)
+        return source
+    if gap_index.size == gapmask.size:
+        source = gap_index
+    elif bands is not None:
+        # the valid pixels of a band mask are the product of the valid rows
+        # and columns, so the nearest one is found per axis
+        rows, cols = (ndimage.distance_transform_edt(profile,
+                                                     return_distances=False,
+                                                     return_indices=True)[0]
+                      for profile in bands)
+        yy, xx = np.divmod(gap_index, gapmask.shape[1])
+        source = rows[yy] * gapmask.shape[1] + cols[xx]
+    else:
+        index = ndimage.distance_transform_edt(gapmask,
+                                               return_distances=False,
+                                               return_indices=True)
+        source = (index[0].ravel()[gap_index] * gapmask.shape[1] +
+                  index[1].ravel()[gap_index])
+    _NEAREST_CACHE[mask_key] = source
+    while len(_NEAREST_CACHE) > _NEAREST_CACHE_SIZE:
+        _NEAREST_CACHE.popitem(last=False)
+    return source
+
+
+def _spline_values(coeffs, coords, dtype):
+    frames = coeffs.reshape((-1, ) + coeffs.shape[-2:])
+    values = np.empty((frames.shape[0], coords.shape[1]), dtype=dtype)
+    for frame, out in zip(frames, values):
+        ndimage.map_coordinates(frame,
+                                coords,
+                                output=out,
+                                order=3,
+                                mode="mirror",
+                                prefilter=False)
+    return values.reshape(coeffs.shape[:-2] + (-1, ))
+
+
+def _gap_bands(gapmask, count):
+    # (rows, cols) profiles if the mask is a union of full rows and columns;
+    # the union is contained in the mask, so equal pixel counts suffice
+    rows = gapmask.all(axis=1)
+    cols = gapmask.all(axis=0)
+    nrows, ncols = rows.sum(), cols.sum()
+    union = nrows * cols.size + ncols * rows.size - nrows * ncols
+    if union == count:
+        return rows, cols
+    return None
+
+
+def _band_residual(bands, targets, x, y, reach=1, every=False):
+    rows, cols = bands
+    yy, xx = np.divmod(targets, cols.size)
+    return (_axis_residual(rows, y, reach, every)[yy]
+            | _axis_residual(cols, x, reach, every)[xx])
+
+
+def _axis_residual(bands, shift, reach, every=False):
+    # True where the footprint of i + shift along one axis, floor - reach + 1
+    # to floor + reach for a fractional position, leaves the detector or
+    # contains a gap band (lies in gap bands only, with every=True)
+    n = bands.size
+    p = np.arange(n) + shift
+    inside = (p >= 0) & (p <= n - 1)
+    lo = np.floor(p)
+    frac = p > lo
+    hi = np.clip(np.where(frac, lo + reach, lo), 0, n - 1).astype(np.intp)
+    lo = np.clip(np.where(frac, lo - reach + 1, lo), 0, n - 1).astype(np.intp)
+    count = np.concatenate([[0], np.cumsum(bands)])
+    if every:
+        return ~inside | (count[hi + 1] - count[lo] == hi - lo + 1)
+    return ~inside | (count[hi + 1] > count[lo])
+
+
+def _dilate_gap(gapmask, x, y):
+    # gap pixels within the cubic support, floor - 1 to floor + 2, along
+    # the fractional axes, indexed by the floor of the shifted position
+    touch = gapmask
+    for axis, shift in ((0, y), (1, x)):
+        if shift % 1:
+            touch = ndimage.maximum_filter1d(touch,
+                                             4,
+                                             axis=axis,
+                                             mode="nearest",
+                                             origin=-1)
+    return touch
+
+
+def _as_transform(shift):
+    # hashable (x, y) shift or 2x3 affine; an affine without rotation or
+    # scale is a shift
+    transform = np.asarray(shift, dtype=float)
+    if transform.shape == (2, 3) and np.array_equal(transform[:, :2],
+                                                    np.eye(2)):
+        transform = transform[:, 2]
+    if transform.shape == (2, ):
+        return (float(transform[0]), float(transform[1]))
+    if transform.shape == (2, 3):
+        return tuple(tuple(row) for row in transform.tolist())
+    raise ValueError(f"Expected an (x, y) shift or a 2x3 affine transform, "
+                     f"got shape {transform.shape}")
+
+
+def _inside(coords, shape):
+    # map_coordinates(mode="constant") returns 0 outside [0, n - 1]
+    ny, nx = shape
+    return ((coords[0] >= 0) & (coords[0] <= ny - 1) & (coords[1] >= 0)
+            & (coords[1] <= nx - 1))
+
+
+def _shifted_coords(targets, shape, x, y):
+    yy, xx = np.divmod(targets, shape[1])
+    coords = np.stack([yy + y, xx + x])
+    return coords, _inside(coords, shape)
+
+
+def _affine_coords(targets, shape, matrix):
+    # source (y, x) of every target for x' = a x + b y + c, y' = d x + e y + f
+    (a, b, c), (d, e, f) = matrix
+    yy, xx = np.divmod(targets, shape[1])
+    coords = np.stack([d * xx + e * yy + f, a * xx + b * yy + c])
+    return coords, _inside(coords, shape)
+
+
+def _nearest_gather(coords, shape):
+    ny, nx = shape
+    py, px = np.floor(coords + 0.5).astype(np.intp)
+    inside = (py >= 0) & (py < ny) & (px >= 0) & (px < nx)
+    index = np.where(inside, py * nx + px, 0)
+    return index, inside
+
+
+def _bilinear_gather(coords, shape):
+    ny, nx = shape
+    py, px = coords
+    inside = _inside(coords, shape)
+    y0 = np.floor(py)
+    x0 = np.floor(px)
+    fy = py - y0
+    fx = px - x0
+    y0 = np.clip(y0, 0, ny - 1).astype(np.intp)
+    x0 = np.clip(x0, 0, nx - 1).astype(np.intp)
+    y1 = np.minimum(y0 + 1, ny - 1)
+    x1 = np.minimum(x0 + 1, nx - 1)
+    if not fy.any():
+        # horizontal move: linear blend along the row
+        index = np.stack([y0 * nx + x0, y0 * nx + x1])
+        weights = np.stack([1 - fx, fx])
+    elif not fx.any():
+        # vertical move: linear blend along the column
+        index = np.stack([y0 * nx + x0, y1 * nx + x0])
+        weights = np.stack([1 - fy, fy])
+    else:
+        index = np.stack(
+            [y0 * nx + x0, y0 * nx + x1, y1 * nx + x0, y1 * nx + x1])
+        weights = np.stack([(1 - fy) * (1 - fx), (1 - fy) * fx,
+                            fy * (1 - fx), fy * fx])
+    weights[:, ~inside] = 0
+    return index, weights
+
+
+_PLAN_CACHE = OrderedDict()
+_PLAN_CACHE_SIZE = 4
+
+
+def _mask_key(gapmask):
+    return hashlib.sha1(np.packbits(gapmask)).hexdigest()
+
+
+def get_fill_plan(mask, shifts, shape=None, **options):
+    gapmask = np.asarray(mask) > 0
+    if shape is not None and gapmask.shape != tuple(shape):
+        raise ValueError(f"Mask shape {gapmask.shape} does not match "
+                         f"detector shape {tuple(shape)}")
+    key = (gapmask.shape,
+           tuple(_as_transform(shift) for shift in shifts),
+           _mask_key(gapmask),
+           tuple(sorted(options.items())))
+    plan = _PLAN_CACHE.get(key)
+    if plan is None:
+        plan = GapFillPlan(gapmask, shifts, **options)
+        _PLAN_CACHE[key] = plan
+        while len(_PLAN_CACHE) > _PLAN_CACHE_SIZE:
+            _PLAN_CACHE.popitem(last=False)
+    else:
+        _PLAN_CACHE.move_to_end(key)
+    return plan
+
+
+def residual_gap(mask, x, y):
+    """Gap pixels that a move by (x, y) pixels cannot fill.
+
+    These are the gap pixels whose shifted source lies off the detector or
+    touches a gap pixel (see ``GapFillPlan``), i.e. the pixels a second
+    move has to fill.
+    """
+    plan = get_fill_plan(mask, [(x, y)])
+    residual = np.zeros(plan.shape, dtype=bool)
+    residual.ravel()[plan._left] = True
+    residual &= np.asarray(mask) > 0
+    return residual
+
+
+def _invalid(values, saturation):
+    # negative (the -1 and -2 flags of Pilatus detectors), NaN and, with a
+    # saturation, saturated values
+    invalid = ~(values >= 0)
+    if saturation is not None:
+        invalid |= values >= saturation
+    return invalid
+
+
+def _failed_taps(values, weights, saturation, bad=None):
+    # per frame, the targets with an invalid tap of non-zero weight; the
+    # taps are on the second last axis of values when weights are given
+    if bad is None:
+        bad = _invalid(values, saturation)
+    if weights is not None:
+        bad = np.any(bad & (weights != 0), axis=-2)
+    return bad
+
+
+def _any_frame(flags):
+    # flags set in any frame of the leading axes
+    return flags.any(axis=tuple(range(flags.ndim - 1)))
+
+
+def _hand_on(failures, k, targets, failed):
+    # record the targets of move k whose source is invalid in some frame
+    hit = _any_frame(failed)
+    if hit.any():
+        failures.append((k, targets[hit], failed[..., hit]))
+
+
+def _nearest_pixel(holes, shape, pixels):
+    # nearest pixel outside holes of every pixel, looked up in a window
+    # around it; a pixel whose window is all holes falls back to a
+    # distance transform of the whole frame
+    ny, nx = shape
+    radius = INPAINT_RADIUS
+    dy, dx = np.mgrid[-radius:radius + 1, -radius:radius + 1].reshape(2, -1)
+    order = np.argsort(dy * dy + dx * dx, kind="stable")
+    dy, dx = dy[order, None], dx[order, None]
+    yy, xx = np.divmod(pixels, nx)
+    yy, xx = yy + dy, xx + dx
+    inside = (yy >= 0) & (yy < ny) & (xx >= 0) & (xx < nx)
+    candidates = np.where(inside, yy * nx + xx, 0)
+    usable = inside & ~holes[candidates]
+    found = usable.any(axis=0)
+    source = candidates[usable.argmax(axis=0), np.arange(pixels.size)]
+    if not found.all():
+        nearest = ndimage.distance_transform_edt(holes.reshape(shape),
+                                                 return_distances=False,
+                                                 return_indices=True)
+        far = pixels[~found]
+        source[~found] = (nearest[0].ravel()[far] * nx +
+                          nearest[1].ravel()[far])
+    return source
+
+
+def _copy_where(outputs, pixels, source, where):
+    # copy the source pixels into pixels in the frames flagged by where
+    for output in outputs:
+        output[..., pixels] = np.where(where, output[..., source],
+                                       output[..., pixels])
+
+
+def fill_operator(mask, shifts, flatfield=None, dtype=np.float64, **options):
+    """Sparse CSR matrix of the fill for the given mask and pixel shifts.
+
+    See ``GapFillPlan.as_operator``.
+    """
+    plan = get_fill_plan(mask, shifts, **options)
+    return plan.as_operator(flatfield, dtype=dtype)
+
+
+def register_shift(data0, moved, mask=None, method="phase", workers=1):
+    """Shift (x, y) in pixels of ``moved`` against ``data0``.
+
+    The shift is the one ``fill_gap`` takes: ``moved`` sees at p + (x, y)
+    what ``data0`` sees at p, returned as floats. ``mask`` marks the gap
+    pixels, which are not matched, like negative and NaN pixels, and
+    ``method`` is one of ``REGISTER_METHODS``.
+    """
+    if method not in REGISTER_METHODS:
+        raise ValueError(f"Unsupported registration method: {method}")
+    shape = np.shape(data0)
+    if np.shape(moved) != shape:
+        raise ValueError(f"Frame shape {np.shape(moved)} does not match "
+                         f"{shape}")
+    # coarse to fine on the pyramids of both frames, first as the peak of a
+    # correlation of the whole first level whose larger side is at most
+    # REGISTER_SIZE. "phase" is the FFT phase correlation of Hann-windowed
+    # levels with invalid bins set to the mean of the valid ones; the gaps
+    # then still look alike in every frame, which pulls small shifts
+    # towards zero. "masked" is the masked normalised cross-correlation of
+    # Padfield (2012), which leaves them out. The coarse spectra of data0
+    # and of the bin masks are cached, so registering several frames
+    # against the same original transforms those once.
+    pyramid0 = frame_pyramid(data0, mask)
+    pyramid1 = frame_pyramid(moved, mask)
+    start = next((k for k, level in enumerate(pyramid0)
+                  if max(level.values.shape) <= REGISTER_SIZE),
+                 len(pyramid0) - 1)
+    correlate = (_masked_correlation
+                 if method == "masked" else _phase_correlation)
+    binning = pyramid0[start].binning
+    y, x = _peak_position(
+        correlate(pyramid0[start], pyramid1[start], workers, cached=True))
+    y, x = y * binning, x * binning
+    coarse = pyramid0[start]
+    # then at every finer level as the residual peak of the summed masked
+    # correlations of up to REGISTER_WINDOWS windows of at most
+    # REGISTER_WINDOW bins where the first level has the most structure;
+    # windows with less than REGISTER_VALID valid bins are left out, and
+    # the coarser estimate is kept when none is left or the summed peak is
+    # below REGISTER_PEAK per window
+    for k in reversed(range(start)):
+        binning = pyramid0[k].binning
+        shift = (round(y / binning), round(x / binning))
+        scale = coarse.binning // binning
+        correlation, count = 0, 0
+        for centre in _window_centres(coarse, REGISTER_WINDOW // scale + 1):
+            windows = _register_windows(pyramid0[k].values.shape, shift,
+                                        [c * scale for c in centre])
+            if windows is None:
+                break
+            reference = _level_window(pyramid0[k], windows[0])
+            if reference.valid.mean() < REGISTER_VALID:
+                continue
+            # the phase correlation of a window is pulled by the gaps, which
+            # lie elsewhere in the moved window, and by the noise it whitens.
+            # Only shifts of the residual and the neighbours of its peak
+            # are needed.
+            correlation = correlation + _masked_correlation(
+                reference, _level_window(pyramid1[k], windows[1]), workers,
+                lags=4)
+            count += 1
+        if not count or np.max(correlation) < REGISTER_PEAK * count:
+            break
+        dy, dx = _peak_position(correlation)
+        # the residual of a sound coarser estimate is within a bin or two
+        if max(abs(dy), abs(dx)) > 2:
+            break
+        y, x = (shift[0] + dy) * binning, (shift[1] + dx) * binning
+    return float(x), float(y)
+
+
+def _window_centres(level, size):
+    # centres, in bins of level, of up to REGISTER_WINDOWS size x size
+    # windows apart with the most structure along both axes: the smaller
+    # eigenvalue of the structure tensor of the valid bins summed over the
+    # window. A window on a single ring or streak only fixes the shift
+    # across it.
+    values = level.values.astype(np.float32)
+    valid = level.valid
+    gy = np.diff(values, axis=0)[:, :-1]
+    gy[~(valid[1:, :-1] & valid[:-1, :-1])] = 0
+    gx = np.diff(values, axis=1)[:-1]
+    gx[~(valid[:-1, 1:] & valid[:-1, :-1])] = 0
+    a, c, b = (ndimage.uniform_filter(t, size, mode="constant")
+               for t in (gx * gx, gy * gy, gx * gy))
+    score = (a + c) / 2 - np.sqrt(np.square((a - c) / 2) + np.square(b))
+    centres = []
+    for _ in range(REGISTER_WINDOWS):
+        i, j = np.unravel_index(np.argmax(score), score.shape)
+        if not score[i, j] > 0:
+            break
+        centres.append((i + 0.5, j + 0.5))
+        score[max(i - size + 1, 0):i + size, max(j - size + 1, 0):j + size] = 0
+    return centres
+
+
+def _register_windows(shape, shift, centre):
+    # index of windows of at most REGISTER_WINDOW bins in the reference
+    # level, as close to centre as the overlap allows, and, moved by
+    # shift, in the moved level; None when the overlap is too small
+    reference, moved = [], []
+    for n, s, c in zip(shape, shift, centre):
+        size = min(REGISTER_WINDOW, n - abs(s))
+        if size < 8:
+            return None
+        lo, hi = max(0, -s), min(n - size, n - size - s)
+        start = min(max(int(round(c - size / 2)), lo), hi)
+        reference.append(slice(start, start + size))
+        moved.append(slice(start + s, start + s + size))
+    return tuple(reference), tuple(moved)
+
+
+def _level_window(level, index):
+    return PyramidLevel(level.binning, level.values[index], level.valid[index])
+
+
+def _phase_correlation(reference, moved, workers, cached=False):
+    # phase correlation of two levels of the same shape; a Gaussian
+    # low-pass turns its peak into a Gaussian of REGISTER_SIGMA bins, which
+    # the log-parabola fit locates exactly
+    if cached:
+        spectrum = _frame_cached(
+            "phase", reference.values, (reference.valid, ), None, np.float32,
+            lambda: _phase_spectrum(reference, workers))
+    else:
+        spectrum = _phase_spectrum(reference, workers)
+    cross = _phase_spectrum(moved, workers)
+    cross *= spectrum.conj()
+    cross /= np.maximum(np.abs(cross), np.finfo(np.float32).tiny)
+    shape = reference.values.shape
+    k2 = (fft.fftfreq(shape[0])**2)[:, None] + fft.rfftfreq(shape[1])**2
+    cross *= np.exp(-2 * (np.pi * REGISTER_SIGMA)**2 * k2).astype(np.float32)
+    return fft.irfft2(cross, s=shape, workers=workers)
+
+
+def _phase_spectrum(level, workers):
+    # spectrum of the mean-free and windowed level, with its invalid bins
+    # set to the mean of the valid ones
+    data = np.array(level.values, dtype=np.float32)
+    data[~level.valid] = data[level.valid].mean() if level.valid.any() else 0
+    data -= data.mean()
+    data *= np.hanning(data.shape[0]).astype(np.float32)[:, None]
+    data *= np.hanning(data.shape[1]).astype(np.float32)
+    return fft.rfft2(data, workers=workers)
+
+
+def _masked_correlation(reference, moved, workers, cached=False, lags=None):
+    # masked normalised cross-correlation of two levels of the same shape,
+    # zero-padded against wrap-around and zero where the valid bins overlap
+    # less than REGISTER_OVERLAP of the most. With lags, it is only padded
+    # for shifts up to lags bins and zero at the larger ones.
+    if cached:
+        f, ff, m0, size = _frame_cached(
+            "masked", reference.values, (reference.valid, ), None,
+            np.float32, lambda: _masked_spectra(reference, workers, True))
+    else:
+        f, ff, m0, size = _masked_spectra(reference, workers, lags=lags)
+    g, gg, m1, _ = _masked_spectra(moved, workers, cached, lags)
+
+    def correlate(a, b):
+        # sum over p of a(p) b(p + u), for every shift u
+        return fft.irfft2(a.conj() * b, s=size, workers=workers)
+
+    def reference_terms():
+        overlap = np.rint(correlate(m0, m1))
+        trusted = overlap >= max(REGISTER_OVERLAP * overlap.max(), 1)
+        overlap[~trusted] = np.inf
+        sum_f = correlate(f, m1)
+        return trusted, overlap, sum_f, correlate(
+            ff, m1) - np.square(sum_f) / overlap
+
+    if cached:
+        # the terms of the reference only change with the bin mask of
+        # moved, whose cached spectrum m1 keys them
+        trusted, overlap, sum_f, variance_f = _frame_cached(
+            "masked terms", reference.values, (reference.valid, m1), None,
+            np.float32, reference_terms)
+    else:
+        trusted, overlap, sum_f, variance_f = reference_terms()
+    sum_g = correlate(m0, g)
+    numerator = correlate(f, g) - sum_f * sum_g / overlap
+    variance = correlate(m0, gg) - np.square(sum_g) / overlap
+    variance *= variance_f
+    if lags is not None:
+        # shifts over lags bins wrap around
+        trusted[lags + 1:size[0] - lags] = False
+        trusted[:, lags + 1:size[1] - lags] = False
+    correlation = np.divide(numerator,
+                            np.sqrt(np.maximum(variance, 0)),
+                            out=np.zeros(size, dtype=np.float32),
+                            where=trusted & (variance > 0))
+    # the same Gaussian peak as the phase correlation, for the same fit
+    return ndimage.gaussian_filter(correlation, REGISTER_SIGMA, mode="wrap")
+
+
+def _masked_spectra(level, workers, cached=False, lags=None):
+    # spectra of the standardised valid bins of a level and of their
+    # square, and of the mask of the valid bins, padded for shifts up to
+    # lags bins (by default all)
+    keep = level.valid
+    data = level.values[keep].astype(np.float32)
+    if data.size:
+        data -= data.mean()
+        data /= max(data.std(), np.finfo(np.float32).tiny)
+    size = tuple(
+        fft.next_fast_len(n + (n - 1 if lags is None else min(lags, n - 1)),
+                          True) for n in keep.shape)
+    values = np.zeros(keep.shape, dtype=np.float32)
+    values[keep] = data
+    spectra = [
+        fft.rfft2(x, s=size, workers=workers)
+        for x in (values, np.square(values))
+    ]
+    if cached:
+        mask = _mask_spectrum(keep, size, workers)
+    else:
+        mask = fft.rfft2(keep.astype(np.float32), s=size, workers=workers)
+    return spectra[0], spectra[1], mask, size
+
+
+_MASK_SPECTRUM_CACHE = OrderedDict()
+_MASK_SPECTRUM_CACHE_SIZE = 4
+
+
+def _mask_spectrum(keep, size, workers):
+    # spectrum of a bin mask, cached per mask: the detector gaps and dead
+    # pixels give the same mask for every frame of a detector
+    key = (_mask_key(keep), size)
+    spectrum = _MASK_SPECTRUM_CACHE.get(key)
+    if spectrum is None:
+        spectrum = fft.rfft2(keep.astype(np.float32), s=size, workers=workers)
+        _MASK_SPECTRUM_CACHE[key] = spectrum
+        while len(_MASK_SPECTRUM_CACHE) > _MASK_SPECTRUM_CACHE_SIZE:
+            _MASK_SPECTRUM_CACHE.popitem(last=False)
+    else:
+        _MASK_SPECTRUM_CACHE.move_to_end(key)
+    return spectrum
+
+
+def _peak_position(correlation):
+    # signed position of the correlation peak, refined by a paraboloid
+    # through the logarithm of the peak and its eight (periodic)
+    # neighbours. Its cross term follows a peak stretched along a ring or
+    # streak at a slant, which a parabola per axis would not; where the
+    # paraboloid has no maximum next to the peak, a parabola per axis.
+    shape = correlation.shape
+    peak = np.unravel_index(np.argmax(correlation), shape)
+    rows = (peak[0] + np.arange(-1, 2)) % shape[0]
+    columns = (peak[1] + np.arange(-1, 2)) % shape[1]
+    values = correlation[np.ix_(rows, columns)].astype(np.float64)
+    if values.min() > 0:
+        values = np.log(values)
+    gradient = np.array([values[2, 1] - values[0, 1],
+                         values[1, 2] - values[1, 0]]) / 2
+    curvature = np.array([values[2, 1] + values[0, 1], values[1, 2] +
+                          values[1, 0]]) - 2 * values[1, 1]
+    cross = (values[2, 2] - values[2, 0] - values[0, 2] + values[0, 0]) / 4
+    hessian = np.array([[curvature[0], cross], [cross, curvature[1]]])
+    delta = None
+    if curvature[0] < 0 and np.linalg.det(hessian) > 0:
+        delta = -np.linalg.solve(hessian, gradient)
+    if delta is None or np.abs(delta).max() > 1:
+        delta = np.where(curvature < 0,
+                         -gradient / np.where(curvature < 0, curvature, 1), 0)
+    position = []
+    for p, n in zip(np.add(peak, delta), shape):
+        p = float(p)
+        position.append(p - n if p > n / 2 else p)
+    return position
+
+
+# level of a frame pyramid: the bin size in pixels, the means of the valid
+# pixels of every bin and where all of them are valid
+PyramidLevel = namedtuple("PyramidLevel", "binning values valid")
+
+
+def frame_pyramid(frame, mask=None, cache=True):
+    """Block-mean pyramid of a (ny, nx) frame, as a list of ``PyramidLevel``.
+
+    Level k bins 2**k x 2**k pixels: its ``values`` are the means of the
+    valid pixels of every bin (zero where there are none) and ``valid``
+    marks the bins whose pixels are all valid, i.e. neither in ``mask`` nor
+    negative or NaN. Level 0 holds the frame itself, and every level is
+    built from the one before, down to the first whose larger side is at
+    most ``PYRAMID_SIZE``. Pyramids are cached per frame and mask; frames
+    are keyed by identity and assumed not to be modified in place, so
+    arrays that are (pooled fill buffers) take ``cache=False``.
+    """
+    gapmask = None if mask is None else np.asarray(mask) > 0
+    if not cache:
+        return _build_pyramid(frame, gapmask)
+    mask_key = None if gapmask is None else _mask_key(gapmask)
+    return _frame_cached("pyramid",
+                         frame, (),
+                         mask_key,
+                         np.float32,
+                         lambda: _build_pyramid(frame, gapmask),
+                         cache=_PYRAMID_CACHE,
+                         size=_PYRAMID_CACHE_SIZE)
+
+
+def _build_pyramid(frame, gapmask):
+    data = np.asarray(frame)
+    valid = data >= 0
+    if gapmask is not None:
+        valid &= ~gapmask
+    levels = [PyramidLevel(1, data, valid)]
+    # sums and counts of the valid pixels, halved level by level
+    sums = data.astype(np.float32)
+    sums[~valid] = 0
+    counts = valid
+    while max(sums.shape) > PYRAMID_SIZE and min(sums.shape) >= 2:
+        sums, counts = _block_sum(sums, 2), _block_sum(counts, 2)
+        binning = 2 * levels[-1].binning
+        values = np.divide(sums,
+                           counts,
+                           out=np.zeros_like(sums),
+                           where=counts > 0)
+        levels.append(PyramidLevel(binning, values, counts == binning**2))
+    return levels
+
+
+def _block_sum(image, binning):
+    # float32 sum over binning x binning blocks, dropping the incomplete
+    # ones, by strided adds (reductions over such short axes are slow)
+    ny, nx = (n // binning for n in image.shape)
+    image = image[:ny * binning, :nx * binning]
+    rows = image[0::binning].astype(np.float32)
+    for i in range(1, binning):
+        rows += image[i::binning]
+    blocks = rows[:, 0::binning].copy()
+    for i in range(1, binning):
+        blocks += rows[:, i::binning]
+    return blocks
+
+
+class BufferPool:
+    """Reusable output arrays keyed by (shape, dtype).
+
+    A buffer handed out by ``get`` is handed out again on the next request
+    with the same key, so its content is only valid until then.
+    """
+
+    def __init__(self, maxsize=4):
+        self.maxsize = maxsize
+        self._buffers = OrderedDict()
+
+    def get(self, shape, dtype=np.float64):
+        key = (tuple(shape), np.dtype(dtype))
+        buffer = self._buffers.pop(key, None)
+        if buffer is None:
+            buffer = np.empty(key[0], dtype=key[1])
+        self._buffers[key] = buffer
+        while len(self._buffers) > self.maxsize:
+            self._buffers.popitem(last=False)
+        return buffer
+
+    def clear(self):
+        self._buffers.clear()
+
+
+def fill_gap(flatfield,
+             mask,
+             data0,
+             data1,
+             data2,
+             x1,
+             y1,
+             x2,
+             y2,
+             out=None,
+             dtype=np.float32,
+             workers=1,
+             dark=None,
+             monitor=None,
+             variance=False,
+             provenance=False,
+             mask_invalid=False,
+             saturation=None,
+             **options):
+    """Fill the gaps of ``data0`` from one or two moved frames.
+
+    The frames are (ny, nx) images or stacks with leading axes (see
+    ``fill_gap_stack``). ``dark`` and ``monitor`` (one entry per frame)
+    are corrections applied by ``GapFillPlan.fill``, which with
+    ``variance=True`` and ``provenance=True`` also returns the variance and
+    provenance map.
+    Extra keyword arguments are plan options passed on to ``GapFillPlan``.
+
+    With ``mask_invalid=True`` the invalid pixels of ``data0`` (negative,
+    NaN or saturated) are filled like gap pixels, and those of the moved
+    frames are never used as sources (see ``GapFillPlan.fill``).
+    """
+    # the second shift is only used, and checked, with a second frame
+    shifts = [(x1, y1)]
     if data2 is not None:
-        mask = gapmask.copy().astype(np.float64)
-        mask1 = mask.copy()
-        mask1[gapmask] = map_coordinates(mask, np.asarray([py, px]), order=1)
-        mask2 = mask1 > 0
-        yy2, xx2 = np.where(mask2)
-        py2 = yy2 + y2
-        px2 = xx2 + x2
-        data[mask2] = map_coordinates(data2 * flatfield,
-                                      np.asarray([py2, px2]),
-                                      order=1)
-    return data
+        shifts.append((x2, y2))
+    plan = get_fill_plan(mask, shifts, np.shape(data0)[-2:], **options)
+    return plan.fill(flatfield,
+                     data0,
+                     data1,
+                     data2,
+                     out=out,
+                     dtype=dtype,
+                     workers=workers,
+                     dark=dark,
+                     monitor=monitor,
+                     variance=variance,
+                     provenance=provenance,
+                     mask_invalid=mask_invalid,
+                     saturation=saturation)
+
+
+def fill_gap_stack(flatfield, mask, data0, data1, data2, x1, y1, x2, y2,
+                   **kwargs):
+    """Fill the gaps of a (N, ny, nx) stack of frames in one pass.
+
+    The moved stacks must have the shape of ``data0``. The other arguments
+    are those of ``fill_gap``.
+    """
+    data0 = np.asarray(data0)
+    if data0.ndim != 3:
+        raise ValueError("Expected a (N, ny, nx) stack of original frames")
+    for data in (data1, data2):
+        if data is not None and np.shape(data) != data0.shape:
+            raise ValueError("Moved stacks must match the original stack")
+    return fill_gap(flatfield, mask, data0, data1, data2, x1, y1, x2, y2,
+                    **kwargs)
+
+
+def fill_gap_multi(flatfield,
+                   mask,
+                   data0,
+                   moves,
+                   out=None,
+                   dtype=np.float32,
+                   workers=1,
+                   dark=None,
+                   monitor=None,
+                   variance=False,
+                   provenance=False,
+                   mask_invalid=False,
+                   saturation=None,
+                   **options):
+    """Fill the gaps of ``data0`` from an ordered list of moved frames.
+
+    ``moves`` is a sequence of ``(frame, (x, y))`` pairs in pixels, or of
+    ``(frame, affine)`` pairs with a 2x3 matrix (see ``GapFillPlan``). Each
+    gap pixel is taken from the first frame that covers it. The other
+    arguments are those of ``fill_gap``.
+    """
+    frames = [frame for frame, _ in moves]
+    shifts = [shift for _, shift in moves]
+    plan = get_fill_plan(mask, shifts, np.shape(data0)[-2:], **options)
+    return plan.fill(flatfield,
+                     data0,
+                     *frames,
+                     out=out,
+                     dtype=dtype,
+                     workers=workers,
+                     dark=dark,
+                     monitor=monitor,
+                     variance=variance,
+                     provenance=provenance,
+                     mask_invalid=mask_invalid,
+                     saturation=saturation)